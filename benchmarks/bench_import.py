@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Measure the time needed by pibooth to import the plugin and to start it
+when the upload is disabled, and check that no network, QR code or asyncio
+module is loaded on this path.
+
+Each measure is done in a new interpreter where the modules already loaded
+by pibooth before its plugins (pibooth, pygame, PIL) are imported first, the
+import time is the one reported by ``python -X importtime``. The plugin is
+compiled beforehand, as it is once installed.
+
+Example::
+
+    $ python benchmarks/bench_import.py --budget-ms 50
+    $ python benchmarks/bench_import.py --repeat 10 --budget-ms 30
+
+The exit status is 1 if the median import time exceeds the budget or if a
+heavy module is loaded while the plugin is disabled.
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import py_compile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+
+# Modules which must only be loaded when the plugin really uses them
+HEAVY_MODULES = ('requests', 'urllib3', 'owncloud', 'qrcode', 'asyncio', 'ssl', 'sqlite3',
+                 'http.server', 'xml.etree.ElementTree', 'concurrent.futures')
+
+CHILD = '''
+import sys
+import json
+import time
+sys.path.insert(0, {root!r})
+
+import pibooth
+import pibooth.utils
+import pygame
+import PIL.Image
+
+preloaded = set(sys.modules)
+start = time.perf_counter()
+import pibooth_nextcloud
+imported = time.perf_counter() - start
+
+
+class Config(object):
+
+    def __init__(self):
+        self.values = {{('GENERAL', 'directory'): {directory!r}}}
+
+    def add_option(self, section, option, default, *args):
+        self.values.setdefault((section, option), default)
+
+    def get(self, section, option):
+        return str(self.values[(section, option)])
+
+    def getint(self, section, option):
+        return int(self.values[(section, option)])
+
+    def getfloat(self, section, option):
+        return float(self.values[(section, option)])
+
+    def getboolean(self, section, option):
+        return str(self.values[(section, option)]) == 'True'
+
+
+class App(object):
+
+    previous_picture_file = 'capture.jpg'
+
+
+cfg = Config()
+pibooth_nextcloud.pibooth_configure(cfg)
+cfg.values[('NEXTCLOUD', 'activate')] = False
+app = App()
+start = time.perf_counter()
+pibooth_nextcloud.pibooth_startup(app, cfg)
+pibooth_nextcloud.state_wait_enter(cfg, app, None)
+pibooth_nextcloud.state_processing_exit(app, cfg)
+pibooth_nextcloud.pibooth_cleanup(app)
+disabled = time.perf_counter() - start
+
+print(json.dumps({{'import': imported, 'disabled': disabled,
+                  'loaded': sorted(name for name in {heavy!r} if name in sys.modules and name not in preloaded)}}))
+'''
+
+
+def measure(directory):
+    """Import and start the plugin in a new interpreter
+    Returns: dict - import time reported by the interpreter, start-up time
+                    and heavy modules loaded
+    """
+    code = CHILD.format(root=ROOT, directory=directory, heavy=HEAVY_MODULES)
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True,
+                             env=dict(os.environ, PYGAME_HIDE_SUPPORT_PROMPT='1'))
+    if process.returncode != 0:
+        raise RuntimeError('\n'.join(line for line in process.stderr.splitlines()
+                                     if not line.startswith('import time:')))
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    for line in process.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == 'pibooth_nextcloud':
+            result['import'] = int(fields[1]) / 1e6
+    return result
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def run(args):
+    py_compile.compile(os.path.join(ROOT, 'pibooth_nextcloud.py'), doraise=True)
+    directory = tempfile.mkdtemp(prefix='pibooth-bench-')
+    try:
+        results = [measure(directory) for _ in range(args.repeat)]
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    import_time = median([result['import'] for result in results])
+    disabled_time = median([result['disabled'] for result in results])
+    loaded = sorted(set(name for result in results for name in result['loaded']))
+    print("Import time         : {:.1f} ms (median of {}, budget {} ms)".format(import_time * 1000, args.repeat,
+                                                                             args.budget_ms))
+    print("Disabled start-up   : {:.3f} ms".format(disabled_time * 1000))
+    print("Heavy modules loaded: {}".format(', '.join(loaded) or 'none'))
+    return import_time * 1000 <= args.budget_ms and not loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help="number of interpreters started")
+    parser.add_argument('--budget-ms', type=float, default=50, help="maximum median import time in ms")
+    args = parser.parse_args()
+
+    sys.exit(0 if run(args) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Upload a big file to a local fake Nextcloud server and check that the
+peak memory of the process stays under a ceiling, whatever the file size.
+
+Example::
+
+    $ python benchmarks/bench_memory.py --size-mb 500 --max-rss-mb 150
+    $ python benchmarks/bench_memory.py --size-mb 500 --chunk-mb 0
+
+The exit status is 1 if the ceiling is exceeded or if the upload fails.
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import pibooth_nextcloud  # noqa: E402
+from fake_nextcloud import FakeNextcloud  # noqa: E402
+from bench_upload import BenchConfig, BenchApp  # noqa: E402
+
+
+def peak_rss_mb():
+    """Return the peak resident memory of the process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run(args):
+    server = FakeNextcloud()
+    url = server.start()
+    directory = tempfile.mkdtemp(prefix='pibooth-bench-')
+    try:
+        filename = os.path.join(directory, 'video.mp4')
+        block = os.urandom(1024 * 1024)
+        with open(filename, 'wb') as fp:
+            for _ in range(args.size_mb):
+                fp.write(block)
+
+        cfg = BenchConfig(directory, url, chunk_size_mb=args.chunk_mb)
+        pibooth_nextcloud.pibooth_configure(cfg)
+        app = BenchApp()
+        pibooth_nextcloud.pibooth_startup(app, cfg)
+        start = time.time()
+        while not app.nextcloud.is_connected and time.time() - start < 10:
+            time.sleep(0.01)
+
+        baseline = peak_rss_mb()
+        start = time.time()
+        remote_file = app.nextcloud.remote_path(os.path.basename(filename))
+        uploaded = app.nextcloud.upload_photos(filename, remote_file, True)
+        duration = time.time() - start
+        peak = peak_rss_mb()
+        pibooth_nextcloud.pibooth_cleanup(app)
+
+        size, sha1 = server.files.get(remote_file, (0, None))
+        uploaded = uploaded and size == args.size_mb * 1024 * 1024
+        print("File size           : {} MB".format(args.size_mb))
+        print("Upload mode         : {}".format('chunked' if 0 < args.chunk_mb < args.size_mb else 'single request'))
+        print("Uploaded            : {}".format('yes' if uploaded else 'no'))
+        print("Duration            : {:.2f} s".format(duration))
+        print("Peak RSS before     : {:.1f} MB".format(baseline))
+        print("Peak RSS after      : {:.1f} MB (ceiling {} MB)".format(peak, args.max_rss_mb))
+        return uploaded and peak <= args.max_rss_mb
+    finally:
+        server.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=500, help="size of the file to upload in MB")
+    parser.add_argument('--chunk-mb', type=int, default=10, help="chunked upload threshold in MB (0 to disable)")
+    parser.add_argument('--max-rss-mb', type=int, default=150, help="maximum peak resident memory in MB")
+    parser.add_argument('-v', '--verbose', action='store_true', help="show the plugin logs")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    sys.exit(0 if run(args) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Measure the bytes saved by the web renditions of the captures against
+the CPU time needed to generate them, for several sizes and formats.
+
+Synthetic captures (smooth gradients with sensor-like noise, saved as
+high quality JPEG like a camera does) are generated once, then each
+rendition is made in this process with the function used by the plugin
+workers.
+
+Example::
+
+    $ python benchmarks/bench_rendition.py --count 10 --width 4000 --height 3000
+    $ python benchmarks/bench_rendition.py --max-size 1600 2048 --format jpeg webp --bandwidth-kbps 1000
+
+With ``--bandwidth-kbps``, the upload time saved by each rendition is
+compared to the CPU time spent to generate it.
+"""
+
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+
+from PIL import Image
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import pibooth_nextcloud  # noqa: E402
+
+
+def make_capture(filename, width, height, seed):
+    """Save a synthetic capture of the given size"""
+    texture = Image.effect_noise((max(1, width // 64), max(1, height // 64)), 60 + seed % 20)
+    texture = texture.resize((width, height), Image.BICUBIC)
+    gradient = Image.linear_gradient('L').resize((width, height))
+    radial = Image.radial_gradient('L').resize((width, height))
+    grain = Image.effect_noise((width, height), 8)
+    image = Image.merge('RGB', (Image.blend(texture, gradient, 0.4), Image.blend(radial, grain, 0.3),
+                                Image.blend(texture, grain, 0.2)))
+    image.save(filename, 'JPEG', quality=92)
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def run(args):
+    directory = tempfile.mkdtemp(prefix='pibooth-bench-')
+    try:
+        sources = []
+        for index in range(args.count):
+            filename = os.path.join(directory, 'capture_{:03d}.jpg'.format(index))
+            make_capture(filename, args.width, args.height, index)
+            sources.append(filename)
+        original = sum(os.path.getsize(filename) for filename in sources) / len(sources)
+
+        print("Captures            : {} x {}x{}, {:.2f} MB each".format(args.count, args.width, args.height,
+                                                                      original / 1024 / 1024))
+        print("{:<8} {:>8} {:>12} {:>8} {:>10} {:>10}{}".format(
+            'format', 'max size', 'rendition', 'saved', 'CPU p50', 'CPU max',
+            ' {:>12}'.format('net gain') if args.bandwidth_kbps else ''))
+        for fmt in args.format:
+            for max_size in args.max_size:
+                sizes, cpu_times = [], []
+                for source in sources:
+                    destination = os.path.join(directory, 'web.' + fmt)
+                    cpu_times.append(pibooth_nextcloud.make_web_rendition(source, destination, max_size,
+                                                                          args.quality, fmt))
+                    sizes.append(os.path.getsize(destination))
+                rendition = sum(sizes) / len(sizes)
+                line = "{:<8} {:>8} {:>9.0f} kB {:>7.1f}% {:>7.0f} ms {:>7.0f} ms".format(
+                    fmt, max_size, rendition / 1024, 100.0 * (original - rendition) / original,
+                    median(cpu_times) * 1000, max(cpu_times) * 1000)
+                if args.bandwidth_kbps:
+                    # Upload time of the lightweight copy saved before the
+                    # first QR code can be scanned, minus the CPU time spent
+                    saved = (original - rendition) * 8 / 1000.0 / args.bandwidth_kbps
+                    line += " {:>10.2f} s".format(saved - median(cpu_times))
+                print(line)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=5, help="number of captures")
+    parser.add_argument('--width', type=int, default=4000, help="width of the captures")
+    parser.add_argument('--height', type=int, default=3000, help="height of the captures")
+    parser.add_argument('--max-size', type=int, nargs='+', default=[1600, 2048],
+                        help="maximum sizes of the renditions")
+    parser.add_argument('--format', nargs='+', default=['jpeg', 'webp'], choices=['jpeg', 'webp'],
+                        help="formats of the renditions")
+    parser.add_argument('--quality', type=int, default=80, help="quality of the renditions")
+    parser.add_argument('--bandwidth-kbps', type=int, default=0,
+                        help="upload bandwidth in kbit/s used to compare the time saved to the CPU time")
+    args = parser.parse_args()
+
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
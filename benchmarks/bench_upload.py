@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Drive the plugin hooks against a local fake Nextcloud server and report
+the hook latency and the upload throughput of realistic event scenarios.
+
+Example::
+
+    $ python benchmarks/bench_upload.py --photos 500 --size-kb 3000 --latency 0.05
+    $ python benchmarks/bench_upload.py --scenario outage --failure-rate 0.05
+    $ python benchmarks/bench_upload.py --scenario burst --raw 4 --session-window 0
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import resource
+import threading
+import argparse
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import pibooth_nextcloud  # noqa: E402
+from fake_nextcloud import FakeNextcloud  # noqa: E402
+
+
+class BenchConfig(object):
+
+    """Minimal stand-in for the pibooth configuration."""
+
+    def __init__(self, directory, url, **options):
+        self.values = {
+            ('GENERAL', 'directory'): directory,
+            ('NEXTCLOUD', 'host_nextcloud'): url,
+            ('NEXTCLOUD', 'user_nextcloud'): 'pibooth',
+            ('NEXTCLOUD', 'pass_nextcloud'): 'secret',
+        }
+        self.values.update({('NEXTCLOUD', key): value for key, value in options.items()})
+
+    def has_section(self, section):
+        return any(key[0] == section for key in self.values)
+
+    def has_option(self, section, option):
+        return (section, option) in self.values
+
+    def add_option(self, section, option, default, *args):
+        self.values.setdefault((section, option), default)
+
+    def get(self, section, option):
+        return str(self.values[(section, option)])
+
+    def getint(self, section, option):
+        return int(self.values[(section, option)])
+
+    def getfloat(self, section, option):
+        return float(self.values[(section, option)])
+
+    def getboolean(self, section, option):
+        return str(self.values[(section, option)]) == 'True'
+
+
+class BenchApp(object):
+
+    """Minimal stand-in for the pibooth application."""
+
+    previous_picture_file = None
+
+
+def percentile(values, percent):
+    """Return the given percentile of a list of values"""
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))]
+
+
+def wait_uploaded(app, count, timeout):
+    """Wait until the given number of pictures are uploaded to all targets"""
+    end = time.time() + timeout
+    while time.time() < end:
+        if all(target.journal.count(pibooth_nextcloud.UploadJournal.DONE) >= count
+               for target in [app.nextcloud] + app.nextcloud.targets):
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def client_threads():
+    """Return the number of threads, except the ones of the fake server"""
+    return sum(1 for thread in threading.enumerate() if 'process_request' not in thread.name)
+
+
+def run(args):
+    server = FakeNextcloud(args.latency, args.bandwidth, args.failure_rate, args.quota_mb * 1024 * 1024)
+    url = server.start()
+    extra_servers = [FakeNextcloud(args.latency, args.bandwidth, args.failure_rate, args.quota_mb * 1024 * 1024)
+                     for _ in range(args.targets)]
+    directory = tempfile.mkdtemp(prefix='pibooth-bench-')
+    try:
+        sections = ['TARGET{}'.format(index + 1) for index in range(args.targets)]
+        cfg = BenchConfig(directory, url, useSynchronize=args.synchronize, upload_workers=args.workers,
+                          chunk_size_mb=args.chunk_mb, targets=','.join(sections),
+                          upload_engine=args.engine, upload_concurrency=args.concurrency,
+                          upload_raw=bool(args.raw), session_window=args.session_window)
+        for section, extra_server in zip(sections, extra_servers):
+            cfg.values[(section, 'host_nextcloud')] = extra_server.start()
+        pibooth_nextcloud.pibooth_configure(cfg)
+        app = BenchApp()
+
+        start = time.time()
+        pibooth_nextcloud.pibooth_startup(app, cfg)
+        startup = time.time() - start
+        while not app.nextcloud.is_connected and time.time() - start < 10:
+            time.sleep(0.01)
+
+        payload = os.urandom(args.size_kb * 1024)
+        latencies = []
+        threads = client_threads()
+        start = time.time()
+        for index in range(args.photos):
+            if args.scenario == 'outage' and index == args.photos // 3:
+                server.outage = True
+            if args.scenario == 'outage' and index == 2 * args.photos // 3:
+                server.outage = False
+            filename = os.path.join(directory, 'photo_{:05d}.jpg'.format(index))
+            with open(filename, 'wb') as fp:
+                fp.write(os.urandom(16))  # Each capture has a different content
+                fp.write(payload)
+            app.previous_picture_file = filename
+            if args.raw:
+                # Raw captures saved by pibooth before the final picture
+                app.capture_date = 'capture-{:05d}'.format(index)
+                raw_dir = os.path.join(directory, 'raw', app.capture_date)
+                os.makedirs(raw_dir)
+                for count in range(args.raw):
+                    with open(os.path.join(raw_dir, 'pibooth{:03}.jpg'.format(count)), 'wb') as fp:
+                        fp.write(os.urandom(16))
+                        fp.write(payload)
+            hook_start = time.perf_counter()
+            pibooth_nextcloud.state_processing_exit(app, cfg)
+            latencies.append(time.perf_counter() - hook_start)
+            threads = max(threads, client_threads())
+            if args.scenario == 'burst':
+                if index % args.burst_size == args.burst_size - 1:
+                    time.sleep(args.interval * args.burst_size)
+            else:
+                time.sleep(args.interval)
+
+        files = args.photos * (1 + (0 if args.synchronize else args.raw))  # Raw captures not synchronized
+        uploaded = wait_uploaded(app, files, args.timeout)
+        duration = time.time() - start
+        done = app.nextcloud.journal.count(pibooth_nextcloud.UploadJournal.DONE)
+        targets_done = [target.journal.count(pibooth_nextcloud.UploadJournal.DONE)
+                        for target in app.nextcloud.targets]
+        opened, reused = app.nextcloud.http.stats()
+        if args.engine == 'asyncio':
+            async_opened, async_reused = app.nextcloud.workers.client.stats()
+            opened, reused = opened + async_opened, reused + async_reused
+        breaker = app.nextcloud.http.breaker
+        short_circuited = app.nextcloud.metrics.counters.get(('errors_total', (('stage', 'upload_photos'),
+                                                                               ('status', 'circuit_open'))), 0)
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        pibooth_nextcloud.pibooth_cleanup(app)
+
+        print("Scenario            : {}".format(args.scenario))
+        print("Engine              : {}".format(args.engine))
+        print("Startup             : {:.3f} s".format(startup))
+        print("Hook latency p50    : {:.3f} ms".format(percentile(latencies, 50) * 1000))
+        print("Hook latency p99    : {:.3f} ms".format(percentile(latencies, 99) * 1000))
+        print("Hook latency max    : {:.3f} ms".format(max(latencies) * 1000))
+        print("Uploaded            : {}/{}{}".format(done, files, '' if uploaded else ' (timeout)'))
+        for section, target_done in zip(sections, targets_done):
+            print("Uploaded ({})  : {}/{}".format(section, target_done, files))
+        print("Total duration      : {:.2f} s".format(duration))
+        print("Upload throughput   : {:.2f} MB/s".format(server.used_bytes() / duration / 1024 / 1024))
+        print("Server requests     : {}".format(', '.join('{}={}'.format(*item)
+                                                          for item in sorted(server.requests.items()))))
+        print("Requests per capture: {:.2f}".format(sum(server.requests.values()) / float(args.photos)))
+        print("Client connections  : {} opened, {} reused".format(opened, reused))
+        print("Client threads      : {}".format(threads))
+        print("Circuit breaker     : {}, opened {} time(s), {} upload(s) short-circuited".format(
+            breaker.state, breaker.opened, short_circuited))
+        print("Peak RSS            : {:.1f} MB".format(peak_rss))
+    finally:
+        server.stop()
+        for extra_server in extra_servers:
+            extra_server.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', choices=['steady', 'burst', 'outage'], default='steady',
+                        help="steady captures, bursts of captures, or a server outage during the event")
+    parser.add_argument('--photos', type=int, default=500, help="number of captures")
+    parser.add_argument('--size-kb', type=int, default=500, help="size of each capture in kB")
+    parser.add_argument('--interval', type=float, default=0.01, help="delay in seconds between two captures")
+    parser.add_argument('--burst-size', type=int, default=10, help="number of captures per burst")
+    parser.add_argument('--latency', type=float, default=0.0, help="server latency in seconds")
+    parser.add_argument('--bandwidth', type=int, default=0, help="server bandwidth in bytes/s (0 unlimited)")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="probability of 503 on PUT")
+    parser.add_argument('--quota-mb', type=int, default=100000, help="free space on the server in MB")
+    parser.add_argument('--workers', type=int, default=2, help="number of upload workers")
+    parser.add_argument('--engine', choices=['threads', 'asyncio'], default='threads', help="upload engine")
+    parser.add_argument('--concurrency', type=int, default=16, help="uploads in flight with the asyncio engine")
+    parser.add_argument('--chunk-mb', type=int, default=10, help="chunked upload threshold in MB")
+    parser.add_argument('--targets', type=int, default=0, help="number of extra servers receiving a copy")
+    parser.add_argument('--raw', type=int, default=0, help="number of raw captures uploaded with each picture")
+    parser.add_argument('--session-window', type=float, default=1.0,
+                        help="delay in seconds grouping the queued files in one session (0 to disable)")
+    parser.add_argument('--synchronize', action='store_true', help="use the directory synchronization mode")
+    parser.add_argument('--timeout', type=float, default=300, help="maximum time to wait for the uploads")
+    parser.add_argument('-v', '--verbose', action='store_true', help="show the plugin logs")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
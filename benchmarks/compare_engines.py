@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""Compare the memory and the throughput of the thread-based and of the
+asyncio upload engines, each one run in its own process by
+``bench_upload.py`` with the same scenario.
+
+Example::
+
+    $ python benchmarks/compare_engines.py --photos 300 --latency 0.1 --concurrency 32
+
+Unknown options are given to ``bench_upload.py`` as is.
+"""
+
+import os
+import sys
+import argparse
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+METRICS = ('Uploaded', 'Total duration', 'Upload throughput', 'Hook latency p99',
+           'Client connections', 'Client threads', 'Peak RSS')
+
+
+def run(engine, options):
+    """Run the benchmark with the given engine
+    Returns: dict - reported values by name
+    """
+    output = subprocess.run([sys.executable, os.path.join(HERE, 'bench_upload.py'), '--engine', engine] + options,
+                            stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    values = {}
+    for line in output.splitlines():
+        name, sep, value = line.partition(':')
+        if sep:
+            values[name.strip()] = value.strip()
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', default='2', help="number of threads of the thread-based engine")
+    parser.add_argument('--concurrency', default='16', help="uploads in flight with the asyncio engine")
+    args, options = parser.parse_known_args()
+
+    results = {'threads': run('threads', ['--workers', args.workers] + options),
+               'asyncio': run('asyncio', ['--concurrency', args.concurrency] + options)}
+
+    print("{:<20}{:>24}{:>24}".format('', 'threads ({})'.format(args.workers),
+                                      'asyncio ({})'.format(args.concurrency)))
+    for name in METRICS:
+        print("{:<20}{:>24}{:>24}".format(name, results['threads'].get(name, '-'), results['asyncio'].get(name, '-')))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+"""Local stand-in for a Nextcloud server, used by the benchmarks.
+
+It implements the subset of the OCS and WebDAV APIs used by the plugin
+(status, capabilities, private data, shares, MKCOL, PUT, PROPFIND, chunked
+uploads) and can inject latency, bandwidth limits, random failures, quota
+exhaustion (507), permission errors (403) and network outages.
+"""
+
+import time
+import random
+import hashlib
+import threading
+import http.server
+from urllib.parse import unquote, urlparse, parse_qs
+
+
+OCS_TEMPLATE = ('<?xml version="1.0"?><ocs><meta><status>ok</status><statuscode>100</statuscode>'
+                '<message>OK</message></meta><data>{}</data></ocs>')
+
+CAPABILITIES = ('<version><major>27</major><minor>0</minor><micro>0</micro><string>27.0.0</string>'
+                '<edition></edition></version><capabilities><core><pollinterval>60</pollinterval>'
+                '</core></capabilities>')
+
+
+class FakeNextcloud(object):
+
+    """Fake Nextcloud server running in a background thread."""
+
+    def __init__(self, latency=0.0, bandwidth=0, failure_rate=0.0, quota=10 * 1024 ** 3, forbidden=False):
+        """Initialize the server
+        :param latency: delay in seconds added before each response
+        :type latency: float
+        :param bandwidth: maximum upload rate in bytes per second (0 for unlimited)
+        :type bandwidth: int
+        :param failure_rate: probability to answer 503 to a PUT request
+        :type failure_rate: float
+        :param quota: available space in bytes, 507 is returned when exhausted
+        :type quota: int
+        :param forbidden: answer 403 to every write request
+        :type forbidden: bool
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.quota = quota
+        self.forbidden = forbidden
+        self.outage = False
+        self.files = {}  # path: (size, etag)
+        self.shares = {}  # path: token
+        self.requests = {}  # method: count
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}'.format(self._server.server_port)
+
+    def start(self, port=0):
+        """Start the server, return its URL"""
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', port), self._handler_class())
+        self._server.daemon_threads = True
+        thread = threading.Thread(target=self._server.serve_forever, name="FakeNextcloud")
+        thread.daemon = True
+        thread.start()
+        return self.url
+
+    def stop(self):
+        """Stop the server"""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def used_bytes(self):
+        with self._lock:
+            return sum(size for path, (size, _) in self.files.items() if '/uploads/' not in path)
+
+    def _handler_class(self):
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super(Handler, self).setup()
+                with server._lock:
+                    server.connections += 1
+
+            def handle_one_request(self):
+                if server.outage:
+                    # Simulate a network failure: drop the connection
+                    self.close_connection = True
+                    self.rfile.readline()
+                    return
+                super(Handler, self).handle_one_request()
+
+            def _count(self):
+                with server._lock:
+                    server.requests[self.command] = server.requests.get(self.command, 0) + 1
+                if server.latency:
+                    time.sleep(server.latency)
+
+            def _read_body(self):
+                """Read the request body at the configured bandwidth, return
+                its size and SHA1 without keeping it in memory
+                """
+                length = int(self.headers.get('Content-Length', 0))
+                sha1 = hashlib.sha1()
+                remaining = length
+                start = time.time()
+                while remaining > 0:
+                    block = self.rfile.read(min(65536, remaining))
+                    if not block:
+                        break
+                    sha1.update(block)
+                    remaining -= len(block)
+                    if server.bandwidth:
+                        delay = (length - remaining) / server.bandwidth - (time.time() - start)
+                        if delay > 0:
+                            time.sleep(delay)
+                return length - remaining, sha1.hexdigest()
+
+            def _read_data(self):
+                length = int(self.headers.get('Content-Length', 0))
+                return self.rfile.read(length) if length else b''
+
+            def _send(self, status, body=b'', headers=None):
+                if isinstance(body, str):
+                    body = body.encode('utf-8')
+                self.send_response(status)
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(body)
+
+            def _path(self, url=None):
+                """Return the file path of a WebDAV URL"""
+                path = unquote(urlparse(url or self.path).path)
+                for prefix in ('/remote.php/webdav', '/remote.php/dav/files/'):
+                    if path.startswith(prefix):
+                        path = path[len(prefix):]
+                        if prefix.endswith('files/'):
+                            path = path[path.find('/'):] if '/' in path else '/'
+                        break
+                else:
+                    if path.startswith('/remote.php/dav/uploads/'):
+                        path = '/uploads/' + path[len('/remote.php/dav/uploads/'):]
+                return '/' + path.strip('/')
+
+            def do_GET(self):
+                self._count()
+                url = urlparse(self.path)
+                if url.path == '/status.php':
+                    self._send(200, '{"installed":true,"maintenance":false,"version":"27.0.0"}',
+                               {'Content-Type': 'application/json'})
+                elif url.path.endswith('/cloud/capabilities'):
+                    self._send(200, OCS_TEMPLATE.format(CAPABILITIES))
+                elif '/privatedata/getattribute' in url.path:
+                    self._send(200, OCS_TEMPLATE.format(''))
+                elif url.path.endswith('/shares'):
+                    query = parse_qs(url.query)
+                    with server._lock:
+                        if 'path' in query:
+                            path = '/' + query['path'][0].strip('/')
+                            shares = [(path, server.shares[path])] if path in server.shares else []
+                        else:
+                            shares = sorted(server.shares.items())
+                    data = ''.join(('<element><id>1</id><share_type>3</share_type><path>{}</path><token>{}</token>'
+                                    '<url>{}/s/{}</url></element>').format(path, token, server.url, token)
+                                   for path, token in shares)
+                    self._send(200, OCS_TEMPLATE.format(data))
+                else:
+                    self._send(404)
+
+            do_HEAD = do_GET
+
+            def do_POST(self):
+                self._count()
+                data = parse_qs(self._read_data().decode('utf-8'))
+                if urlparse(self.path).path.endswith('/shares'):
+                    path = '/' + data.get('path', [''])[0].strip('/')
+                    if path not in server.files:
+                        self._send(404)
+                        return
+                    token = server.shares.setdefault(path, hashlib.sha1(path.encode()).hexdigest()[:15])
+                    self._send(200, OCS_TEMPLATE.format(
+                        '<id>1</id><token>{0}</token><url>{1}/s/{0}</url>'.format(token, server.url)))
+                else:
+                    self._send(404)
+
+            def do_MKCOL(self):
+                self._count()
+                self._read_data()
+                path = self._path()
+                if server.forbidden:
+                    self._send(403)
+                elif path in server.files:
+                    self._send(405)
+                else:
+                    with server._lock:
+                        server.files[path] = (0, None)
+                    self._send(201)
+
+            def do_PUT(self):
+                self._count()
+                if server.forbidden:
+                    self._read_body()
+                    self._send(403)
+                    return
+                if server.failure_rate and random.random() < server.failure_rate:
+                    self._read_body()
+                    self._send(503)
+                    return
+                size, sha1 = self._read_body()
+                path = self._path()
+                checksum = self.headers.get('OC-Checksum', '')
+                if checksum.startswith('SHA1:') and checksum[5:] != sha1:
+                    self._send(400)
+                    return
+                if '/uploads/' not in path and server.used_bytes() + size > server.quota:
+                    self._send(507)
+                    return
+                with server._lock:
+                    server.files[path] = (size, sha1)
+                self._send(201, headers={'ETag': '"{}"'.format(sha1[:16]), 'OC-ETag': '"{}"'.format(sha1[:16])})
+
+            def do_MOVE(self):
+                self._count()
+                self._read_data()
+                source = self._path()
+                destination = self._path(self.headers.get('Destination'))
+                if not source.endswith('/.file'):
+                    self._send(400)
+                    return
+                folder = source[:-len('/.file')]
+                with server._lock:
+                    chunks = [key for key in server.files if key.startswith(folder + '/')]
+                    size = sum(server.files.pop(key)[0] for key in chunks)
+                    server.files.pop(folder, None)
+                    server.files[destination] = (size, hashlib.sha1(destination.encode()).hexdigest())
+                self._send(201)
+
+            def do_COPY(self):
+                self._count()
+                self._read_data()
+                source = self._path()
+                destination = self._path(self.headers.get('Destination'))
+                if server.forbidden:
+                    self._send(403)
+                elif source not in server.files:
+                    self._send(404)
+                else:
+                    with server._lock:
+                        exists = destination in server.files
+                        server.files[destination] = server.files[source]
+                    self._send(204 if exists else 201)
+
+            def do_PROPFIND(self):
+                self._count()
+                self._read_data()
+                path = self._path()
+                if path not in server.files and path != '/':
+                    self._send(404)
+                    return
+                entries = [path]
+                if self.headers.get('Depth') == '1':
+                    entries += [key for key in server.files
+                                if key.startswith(path.rstrip('/') + '/') and '/' not in key[len(path) + 1:]]
+                href = urlparse(self.path).path.rstrip('/')
+                responses = []
+                for entry in entries:
+                    size, etag = server.files.get(entry, (0, None))
+                    name = href if entry == path else href + entry[len(path):]
+                    responses.append(
+                        '<d:response><d:href>{}</d:href><d:propstat><d:prop>'
+                        '<d:getetag>"{}"</d:getetag><d:getcontentlength>{}</d:getcontentlength>'
+                        '<d:quota-available-bytes>{}</d:quota-available-bytes>'
+                        '<d:quota-used-bytes>{}</d:quota-used-bytes>'
+                        '</d:prop></d:propstat></d:response>'.format(
+                            name, (etag or '')[:16], size, server.quota - server.used_bytes(),
+                            server.used_bytes()))
+                self._send(207, '<?xml version="1.0"?><d:multistatus xmlns:d="DAV:">{}</d:multistatus>'.format(
+                    ''.join(responses)))
+
+        return Handler
@@ -2,20 +2,31 @@
 
 """Pibooth plugin for Nextcloud upload."""
 
+import sys
 import json
+import base64
+import math
+import socket
+import functools
+import contextlib
+import importlib
+import hashlib
 import os.path
 
-import requests
-
 import os
+import queue
+import random
+import struct
+import shutil
+import itertools
+import collections
+import threading
+import time
 import traceback
-import owncloud
-import qrcode
 import pygame
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image
 
-from urllib.request import Request, urlopen
-from urllib.error import URLError, HTTPError
+from urllib.parse import quote, unquote, urlsplit
 
 import pibooth
 
@@ -24,6 +35,50 @@ from pibooth.utils import LOGGER
 __version__ = "1.0.6"
 
 
+class LazyModule(object):
+
+    """Module imported on first access to one of its attributes.
+
+    The plugin is loaded by pibooth at boot, even when the upload is
+    disabled: the network, QR code and asyncio dependencies are only
+    imported when really used. Once imported, the module replaces the
+    placeholder in the globals of the plugin.
+    """
+
+    def __init__(self, name, alias=None):
+        """Initialize the placeholder
+        :param name: full name of the module to import
+        :type name: str
+        :param alias: global name bound to the module, by default the
+                      top-level package (as done by ``import a.b``)
+        :type alias: str
+        """
+        self.__dict__['_name'] = name
+        self.__dict__['_alias'] = alias
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        if self._alias:
+            globals()[self._alias] = module
+        else:
+            module = sys.modules[self._name.split('.')[0]]
+            globals()[self._name.split('.')[0]] = module
+        return getattr(module, attr)
+
+
+ssl = LazyModule('ssl')
+uuid = LazyModule('uuid')
+http = LazyModule('http.server')
+sqlite3 = LazyModule('sqlite3')
+asyncio = LazyModule('asyncio')
+concurrent = LazyModule('concurrent.futures')
+multiprocessing = LazyModule('multiprocessing')
+requests = LazyModule('requests')
+owncloud = LazyModule('owncloud')
+qrcode = LazyModule('qrcode')
+ET = LazyModule('xml.etree.ElementTree', 'ET')
+
+
 ###########################################################################
 # HOOK pibooth
 ###########################################################################
@@ -50,10 +105,10 @@ def pibooth_configure(cfg):
                    "Nextcloud password",
                    "Password NextCloud", "alpammm")
     cfg.add_option('NEXTCLOUD', 'useSynchronize', True,
-                   "Use Nextcloudcmd for Synchronize Local et Remote directory",
+                   "Synchronize Local et Remote directory (upload only new or modified files)",
                    "useSynchronize", ['True', 'False'])
     cfg.add_option('NEXTCLOUD', 'gallery_app', "direct",
-                   "Gallery app for QR code URL (direct, photos, or gallery)",
+                   "Gallery app for QR code URL (direct, photos or gallery)",
                    "Gallery App", ['direct', 'photos', 'gallery'])
     cfg.add_option('NEXTCLOUD', 'check_quota', True,
                    "Check available disk space before upload",
@@ -61,6 +116,9 @@ def pibooth_configure(cfg):
     cfg.add_option('NEXTCLOUD', 'min_space_mb', 100,
                    "Minimum free space in MB required for upload",
                    "Min Space (MB)", "100")
+    cfg.add_option('NEXTCLOUD', 'quota_refresh', 300,
+                   "Delay in seconds between two requests of the free space on the server",
+                   "Quota Refresh (s)", "300")
     cfg.add_option('NEXTCLOUD', 'qr_position', "top-left",
                    "QR code position on screen (top-left, top-right, bottom-left, bottom-right, center)",
                    "QR Position", ['top-left', 'top-right', 'bottom-left', 'bottom-right', 'center'])
@@ -70,97 +128,209 @@ def pibooth_configure(cfg):
     cfg.add_option('NEXTCLOUD', 'qr_margin', 10,
                    "QR code margin from screen edge in pixels",
                    "QR Margin", "10")
-
+    cfg.add_option('NEXTCLOUD', 'web_rendition', False,
+                   "Upload a lightweight copy of each picture first, the original is uploaded later in 'Originals'",
+                   "Web Rendition", ['True', 'False'])
+    cfg.add_option('NEXTCLOUD', 'web_max_size', 1600,
+                   "Maximum width/height in pixels of the lightweight copy",
+                   "Web Max Size", "1600")
+    cfg.add_option('NEXTCLOUD', 'web_quality', 80,
+                   "Compression quality of the lightweight copy (1-95)",
+                   "Web Quality", "80")
+    cfg.add_option('NEXTCLOUD', 'web_format', "jpeg",
+                   "Image format of the lightweight copy",
+                   "Web Format", ['jpeg', 'webp'])
+    cfg.add_option('NEXTCLOUD', 'chunk_size_mb', 10,
+                   "Files bigger than this size in MB are uploaded by resumable chunks (0 to disable)",
+                   "Chunk Size (MB)", "10")
+    cfg.add_option('NEXTCLOUD', 'probe_interval', 30,
+                   "Delay in seconds between two checks of the server availability",
+                   "Probe Interval (s)", "30")
+    cfg.add_option('NEXTCLOUD', 'http_pool_size', 4,
+                   "Maximum number of keep-alive connections kept open to the server",
+                   "HTTP Pool Size", "4")
+    cfg.add_option('NEXTCLOUD', 'upload_workers', 2,
+                   "Number of background threads uploading pictures",
+                   "Upload Workers", "2")
+    cfg.add_option('NEXTCLOUD', 'upload_engine', 'threads',
+                   "Upload engine: a thread per upload, or many uploads in flight on one asyncio thread",
+                   "Upload Engine", ['threads', 'asyncio'])
+    cfg.add_option('NEXTCLOUD', 'upload_concurrency', 16,
+                   "Maximum number of uploads in flight with the asyncio engine",
+                   "Upload Concurrency", "16")
+    cfg.add_option('NEXTCLOUD', 'upload_queue_size', 200,
+                   "Maximum number of pictures waiting for upload",
+                   "Upload Queue Size", "200")
+    cfg.add_option('NEXTCLOUD', 'spool_dir', '',
+                   "Directory keeping a link to each picture until uploaded (empty to disable)",
+                   "Spool Directory", "")
+    cfg.add_option('NEXTCLOUD', 'spool_max_mb', 1024,
+                   "Maximum size in MB of the spool, the oldest uploaded files are removed first (0 for unlimited)",
+                   "Spool Max Size (MB)", "1024")
+    cfg.add_option('NEXTCLOUD', 'spool_retention_hours', 0,
+                   "Delay in hours after which uploaded files are removed from the spool (0 to keep them)",
+                   "Spool Retention (h)", "0")
+    cfg.add_option('NEXTCLOUD', 'spool_evict_captures', False,
+                   "Also remove the captures from the pibooth directory when they leave the spool",
+                   "Spool Evict Captures", ['True', 'False'])
+    cfg.add_option('NEXTCLOUD', 'metrics_port', 0,
+                   "Port of the local HTTP server exposing metrics (0 to disable)",
+                   "Metrics Port", "0")
+    cfg.add_option('NEXTCLOUD', 'metrics_file', '',
+                   "Path of the JSON file where metrics are periodically saved (empty to disable)",
+                   "Metrics File", "")
+    cfg.add_option('NEXTCLOUD', 'metrics_interval', 60,
+                   "Delay in seconds between two saves of the metrics file",
+                   "Metrics Interval (s)", "60")
+    cfg.add_option('NEXTCLOUD', 'upload_rate_kbps', 0,
+                   "Maximum upload bandwidth in kbit/s (0 for unlimited)",
+                   "Upload Rate (kbit/s)", "0")
+    cfg.add_option('NEXTCLOUD', 'upload_rate_profiles', '',
+                   "Upload bandwidth by time of day, as HH:MM-HH:MM=kbps separated by commas",
+                   "Upload Rate Profiles", "")
+    cfg.add_option('NEXTCLOUD', 'photo_qr', False,
+                   "Display the QR code of the last picture once it is uploaded and shared",
+                   "Photo QR Code", ['True', 'False'])
+    cfg.add_option('NEXTCLOUD', 'gallery_index', False,
+                   "Upload thumbnails and a lightweight index page in each album",
+                   "Gallery Index", ['True', 'False'])
+    cfg.add_option('NEXTCLOUD', 'gallery_index_url', "",
+                   "URL displaying the index page in the QR code, {host} and {token} are replaced by the server "
+                   "and the share token (empty to keep the share link)",
+                   "Gallery Index URL", "")
+    cfg.add_option('NEXTCLOUD', 'album_rotation', 0,
+                   "Create a new album every N minutes, named after the album and the date (0 to disable)",
+                   "Album Rotation (min)", "0")
+    cfg.add_option('NEXTCLOUD', 'album_prefetch', 2,
+                   "Number of next albums created in advance with their share link",
+                   "Album Prefetch", "2")
+    cfg.add_option('NEXTCLOUD', 'upload_raw', False,
+                   "Also upload the raw captures of each picture in a sub-folder of the album",
+                   "Upload Raw Captures", ['True', 'False'])
+    cfg.add_option('NEXTCLOUD', 'session_window', 1.0,
+                   "Files queued within this delay in seconds are uploaded in one session (0 to disable)",
+                   "Session Window (s)", "1.0")
+    cfg.add_option('NEXTCLOUD', 'breaker_threshold', 5,
+                   "Number of consecutive server failures before requests are suspended",
+                   "Breaker Threshold", "5")
+    cfg.add_option('NEXTCLOUD', 'breaker_reset', 10,
+                   "Delay in seconds before trying again a failing server (doubled on each new failure)",
+                   "Breaker Reset (s)", "10")
+    cfg.add_option('NEXTCLOUD', 'targets', '',
+                   "Sections of extra servers/albums receiving a copy of each picture, separated by commas",
+                   "Extra Targets", "")
 
 
 @pibooth.hookimpl
 def pibooth_startup(app, cfg):
 
     """Create the NextcloudUpload instance."""
+    start = time.time()
 
     LOGGER.info("Create the NextcloudUpload Instance")
     app.nextcloud = NextcloudUpload(credentials=None)
+    app.nextcloud.metrics_exporter = MetricsExporter(app.nextcloud.metrics,
+                                                     cfg.getint('NEXTCLOUD', 'metrics_port'),
+                                                     cfg.get('NEXTCLOUD', 'metrics_file'),
+                                                     cfg.getint('NEXTCLOUD', 'metrics_interval'))
+    app.nextcloud.http = HttpPool(cfg.getint('NEXTCLOUD', 'http_pool_size'),
+                                  CircuitBreaker(cfg.getint('NEXTCLOUD', 'breaker_threshold'),
+                                                 cfg.getfloat('NEXTCLOUD', 'breaker_reset')))
+    app.nextcloud.throttle = TokenBucket(cfg.getint('NEXTCLOUD', 'upload_rate_kbps'),
+                                         cfg.get('NEXTCLOUD', 'upload_rate_profiles'))
 
     app.nextcloud.nhost = cfg.get('NEXTCLOUD', 'host_nextcloud')
     app.nextcloud.nuser = cfg.get('NEXTCLOUD', 'user_nextcloud')
     app.nextcloud.npassword = cfg.get('NEXTCLOUD', 'pass_nextcloud')
     app.nextcloud.activate_state = cfg.getboolean('NEXTCLOUD', 'activate')
-    app.nextcloud.rep_photos_nextcloud = cfg.get('NEXTCLOUD', 'rep_photos_nextcloud')
-    app.nextcloud.album_name = cfg.get('NEXTCLOUD', 'album_name')
+    app.nextcloud.rep_photos_nextcloud = '/' + cfg.get('NEXTCLOUD', 'rep_photos_nextcloud').strip('/') + '/'
+    app.nextcloud.album_base = cfg.get('NEXTCLOUD', 'album_name')
+    app.nextcloud.gallery_index = cfg.getboolean('NEXTCLOUD', 'gallery_index')
+    app.nextcloud.gallery_index_url = cfg.get('NEXTCLOUD', 'gallery_index_url').strip()
+    app.nextcloud.photo_qr = cfg.getboolean('NEXTCLOUD', 'photo_qr')
+    app.nextcloud.album_rotation = cfg.getint('NEXTCLOUD', 'album_rotation')
+    app.nextcloud.album_prefetch = cfg.getint('NEXTCLOUD', 'album_prefetch')
+    app.nextcloud.album_name = app.nextcloud.album_for()
     app.nextcloud.useSynchronize = cfg.get('NEXTCLOUD', 'useSynchronize')
     app.nextcloud.local_rep = cfg.get('GENERAL', 'directory')
     app.nextcloud.gallery_app = cfg.get('NEXTCLOUD', 'gallery_app')
     app.nextcloud.check_quota = cfg.getboolean('NEXTCLOUD', 'check_quota')
     app.nextcloud.min_space_mb = cfg.getint('NEXTCLOUD', 'min_space_mb')
+    app.nextcloud.quota.ttl = cfg.getint('NEXTCLOUD', 'quota_refresh')
+    app.nextcloud.monitor.interval = cfg.getint('NEXTCLOUD', 'probe_interval')
     app.nextcloud.qr_position = cfg.get('NEXTCLOUD', 'qr_position')
     app.nextcloud.qr_size = cfg.getint('NEXTCLOUD', 'qr_size')
     app.nextcloud.qr_margin = cfg.getint('NEXTCLOUD', 'qr_margin')
+    app.nextcloud.web_rendition = cfg.getboolean('NEXTCLOUD', 'web_rendition')
+    app.nextcloud.web_max_size = cfg.getint('NEXTCLOUD', 'web_max_size')
+    app.nextcloud.web_quality = cfg.getint('NEXTCLOUD', 'web_quality')
+    app.nextcloud.web_format = cfg.get('NEXTCLOUD', 'web_format')
+    app.nextcloud.chunk_size_mb = cfg.getint('NEXTCLOUD', 'chunk_size_mb')
+    app.nextcloud.upload_workers = cfg.getint('NEXTCLOUD', 'upload_workers')
+    app.nextcloud.upload_queue_size = cfg.getint('NEXTCLOUD', 'upload_queue_size')
+    app.nextcloud.upload_engine = cfg.get('NEXTCLOUD', 'upload_engine')
+    app.nextcloud.spool_dir = cfg.get('NEXTCLOUD', 'spool_dir')
+    app.nextcloud.spool_max_mb = cfg.getint('NEXTCLOUD', 'spool_max_mb')
+    app.nextcloud.spool_retention_hours = cfg.getint('NEXTCLOUD', 'spool_retention_hours')
+    app.nextcloud.spool_evict_captures = cfg.getboolean('NEXTCLOUD', 'spool_evict_captures')
+    app.nextcloud.upload_concurrency = cfg.getint('NEXTCLOUD', 'upload_concurrency')
+    app.nextcloud.upload_raw = cfg.getboolean('NEXTCLOUD', 'upload_raw')
+    app.nextcloud.session_window = cfg.getfloat('NEXTCLOUD', 'session_window')
 
     # Track connection/quota issues for user feedback
     app.nextcloud.last_error = None
 
-    if not app.nextcloud.wait_for_internet_connection():
-        LOGGER.warning("No internet connection available")
-        app.nextcloud.is_connected = False
-        app.nextcloud.last_error = "Pas de connexion internet"
-        app.nextcloud_link_gallery = "Hors ligne"
-    else:
-        app.nextcloud.oc = app.nextcloud.login(
-            app.nextcloud.nhost,
-            app.nextcloud.nuser,
-            app.nextcloud.npassword
-        )
-
-        # Initialize Rep Event on Cloud (Create directory and Share)
-        LOGGER.info("Create Directory and Share")
+    # Nothing is started (and no network module is imported) when disabled
+    if not app.nextcloud.activate_state:
+        LOGGER.info("Nextcloud upload disabled in configuration")
+        app.nextcloud_link = ""
+        app.nextcloud_link_gallery = None
+        return
 
-        if app.nextcloud.is_connected:
-            # Check disk quota if enabled
-            if app.nextcloud.check_quota:
-                quota_ok, quota_msg = app.nextcloud.check_disk_quota()
-                if not quota_ok:
-                    LOGGER.warning("Quota check failed: %s", quota_msg)
-                    app.nextcloud.last_error = quota_msg
+    # Extra servers/albums, options not set in their section are taken
+    # from the [NEXTCLOUD] section
+    for section in cfg.get('NEXTCLOUD', 'targets').split(','):
+        section = section.strip()
+        if not section:
+            continue
+        if not cfg.has_section(section):
+            LOGGER.warning("Nextcloud target section [%s] not found, ignored", section)
+            continue
 
-            LOGGER.info("Create Link (%s)...", app.nextcloud.album_name)
-            app.nextcloud_link, error_msg = app.nextcloud.create_share_dir(
-                app.nextcloud.rep_photos_nextcloud,
-                app.nextcloud.album_name
-            )
+        def get(option):
+            if cfg.has_option(section, option):
+                return cfg.get(section, option)
+            return cfg.get('NEXTCLOUD', option)
 
-            if error_msg:
-                app.nextcloud.last_error = error_msg
+        app.nextcloud.add_target(section, get('host_nextcloud'), get('user_nextcloud'), get('pass_nextcloud'),
+                                 '/' + get('rep_photos_nextcloud').strip('/') + '/', get('album_name'),
+                                 get('gallery_app'))
 
-            LOGGER.info("Create Share remote Dir (%s)...", app.nextcloud_link)
-
-            if app.nextcloud_link:
-                app.nextcloud_link_gallery = app.nextcloud.create_url_gallery(app.nextcloud_link)
-                LOGGER.info("Create Link Gallery (%s)...", app.nextcloud_link_gallery)
-            else:
-                LOGGER.warning("Could not create share link, using fallback")
-                app.nextcloud_link_gallery = "Lien indisponible"
-        else:
-            app.nextcloud_link_gallery = "Non connecte"
+    # Display the last known gallery link (or a placeholder) until the
+    # connection to the server is done in background
+    link = app.nextcloud.cached_share_link()
+    app.nextcloud.link = link
+    if link:
+        app.nextcloud.link_gallery = app.nextcloud.create_url_gallery(link)
+    else:
+        app.nextcloud.link_gallery = "Hors ligne"
+    app.nextcloud_link = link
+    app.nextcloud_link_gallery = app.nextcloud.link_gallery
 
     # Create QrCode image with URL to Gallery on Nextcloud
     LOGGER.info("Create QrCode with URL Link Gallery (%s)...", app.nextcloud_link_gallery)
+    app.nextcloud.qr_image = app.nextcloud.render_qr(app.nextcloud_link_gallery)
 
-    # Clamp qr_size between 3 and 10
-    qr_box_size = max(3, min(10, app.nextcloud.qr_size))
-
-    qr = qrcode.QRCode(version=1,
-                       error_correction=qrcode.constants.ERROR_CORRECT_L,
-                       box_size=qr_box_size,
-                       border=2)
-    qr.add_data(app.nextcloud_link_gallery)
-    qr.make(fit=True)
-    image = qr.make_image(fill_color="black", back_color="white").convert('RGB')
-    image.save(app.nextcloud.local_rep + '/QRCODE.png', "PNG")
-
-    app.nextcloud.qr_image = pygame.image.fromstring(image.tobytes(), image.size, image.mode)
-    LOGGER.info("QR code created with size=%d, position=%s, margin=%d",
-                qr_box_size, app.nextcloud.qr_position, app.nextcloud.qr_margin)
-
+    # Start background upload workers, login, share creation and resume of
+    # the pending uploads are done by the monitor when the server answers
+    for target in [app.nextcloud] + app.nextcloud.targets:
+        target.start_workers()
+        target.monitor.start()
+    if app.nextcloud.spool is not None:
+        # Once the journals of all the targets are open
+        app.nextcloud.spool.evict()
+    app.nextcloud.metrics_exporter.start()
+    app.nextcloud.metrics.observe('duration_seconds', time.time() - start, stage='pibooth_startup')
 
 
 @pibooth.hookimpl
@@ -171,60 +341,195 @@ def state_wait_enter(cfg, app, win):
     :param win: graphical window instance
     """
     LOGGER.info("In state_wait_enter (%s)", app.previous_picture_file)
+    if not app.nextcloud.activate_state:
+        return
 
-    # Display the QR Code at configured position
-    win_rect = win.get_rect()
-    qr_rect = app.nextcloud.qr_image.get_rect()
-
-    margin = app.nextcloud.qr_margin
-    position = app.nextcloud.qr_position
-
-    # Calculate position based on configuration
-    if position == "top-left":
-        x, y = margin, margin
-    elif position == "top-right":
-        x, y = win_rect.width - qr_rect.width - margin, margin
-    elif position == "bottom-left":
-        x, y = margin, win_rect.height - qr_rect.height - margin
-    elif position == "bottom-right":
-        x, y = win_rect.width - qr_rect.width - margin, win_rect.height - qr_rect.height - margin
-    elif position == "center":
-        x, y = (win_rect.width - qr_rect.width) // 2, (win_rect.height - qr_rect.height) // 2
-    else:
-        # Default to top-left
-        x, y = margin, margin
+    # Switch to the album of the current period, created in advance
+    for target in [app.nextcloud] + app.nextcloud.targets:
+        album_name = target.album_for()
+        if album_name != target.album_name:
+            target.rotate_album(album_name)
 
-    win.surface.blit(app.nextcloud.qr_image, (x, y))
+    # Swap in the QR code built in background once the share is ready
+    qr_ready = app.nextcloud.qr_ready
+    if qr_ready is not None:
+        app.nextcloud.qr_ready = None
+        app.nextcloud.qr_image = qr_ready
+        app.nextcloud_link = app.nextcloud.link
+        app.nextcloud_link_gallery = app.nextcloud.link_gallery
 
+    # Display the QR Code at configured position, only its rect is touched
+    qr_image = app.nextcloud.display_qr_image()
+    win.surface.blit(qr_image, app.nextcloud.qr_blit_position(win.get_rect().size))
+
+    # The QR code of the last picture replaces it once ready
+    if app.nextcloud.photo_shares is not None:
+        app.nextcloud.photo_shares.displayed = None
+        state_wait_do(app, win)
+
+
+@pibooth.hookimpl
+def state_wait_do(app, win):
+    """Display the QR code of the last picture as soon as its share link
+    is created in background.
+    :param app: application instance
+    :param win: graphical window instance
+    """
+    photo_shares = app.nextcloud.photo_shares
+    if photo_shares is not None and app.previous_picture_file:
+        qr_image = photo_shares.display_qr_image(app.previous_picture_file)
+        if qr_image is not None:
+            win.surface.blit(qr_image, app.nextcloud.qr_blit_position(win.get_rect().size, qr_image))
 
 
 @pibooth.hookimpl
 def state_processing_exit(app, cfg):
-    """Upload picture to Nextcloud album"""
+    """Queue picture for upload to Nextcloud album"""
+    if not app.nextcloud.activate_state:
+        return
     name = app.previous_picture_file
-    rep_photos_nextcloud = app.nextcloud.rep_photos_nextcloud
-    nextcloud_name = app.nextcloud.album_name
-    activate_state = app.nextcloud.activate_state
-    local_rep = app.nextcloud.local_rep
-
-    # Check quota before upload if enabled
-    if app.nextcloud.is_connected and app.nextcloud.check_quota:
-        quota_ok, quota_msg = app.nextcloud.check_disk_quota()
-        if not quota_ok:
-            LOGGER.error("Cannot upload: %s", quota_msg)
-            app.nextcloud.last_error = quota_msg
-            return
+    try:
+        capture_time = os.path.getmtime(name)
+    except OSError:
+        capture_time = time.time()
+    # Album of the period of the capture, even if not rotated yet
+    remote_file = app.nextcloud.remote_path(os.path.basename(name), app.nextcloud.album_for(capture_time))
 
-    if app.nextcloud.useSynchronize == 'True' or app.nextcloud.useSynchronize == True:
-        LOGGER.info("Synchronize Directory local to Remote (%s)...", name)
-        app.nextcloud.synchronize_pics(local_rep, rep_photos_nextcloud, nextcloud_name)
-    else:
-        LOGGER.info("Upload Photo (%s)...", name)
-        app.nextcloud.upload_photos(
-            name,
-            app.nextcloud.rep_photos_nextcloud + nextcloud_name + '/' + os.path.basename(name),
-            activate_state
-        )
+    LOGGER.info("Queue Photo for upload (%s)...", name)
+    with app.nextcloud.metrics.timer('state_processing_exit'):
+        raw_files = []
+        capture_date = getattr(app, 'capture_date', None)
+        if app.nextcloud.upload_raw and capture_date:
+            # Raw captures saved by pibooth next to the picture
+            raw_dir = os.path.join(os.path.dirname(name), NextcloudUpload.RAW_DIRNAME, capture_date)
+            if os.path.isdir(raw_dir):
+                raw_files = sorted(os.path.join(raw_dir, filename) for filename in os.listdir(raw_dir))
+        app.nextcloud.enqueue_picture(name, remote_file, raw_files, capture_time)
+
+
+@pibooth.hookimpl
+def pibooth_cleanup(app):
+    """Stop background upload workers"""
+    if hasattr(app, 'nextcloud'):
+        for target in [app.nextcloud] + app.nextcloud.targets:
+            target.monitor.stop()
+            target.stop_workers()
+        app.nextcloud.metrics_exporter.stop()
+
+
+###########################################################################
+# Functions
+###########################################################################
+
+def file_checksum(filename, block_size=1024 * 1024):
+    """Return the SHA1 hex digest of a file, read by blocks.
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fp:
+        for block in iter(lambda: fp.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def file_digests(filename, block_size=1024 * 1024):
+    """Return the BLAKE2b and SHA1 hex digests of a file, computed in a
+    single read.
+    Returns: (str, str) - (blake2b, sha1)
+    """
+    blake2 = hashlib.blake2b(digest_size=20)
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fp:
+        for block in iter(lambda: fp.read(block_size), b''):
+            blake2.update(block)
+            sha1.update(block)
+    return blake2.hexdigest(), sha1.hexdigest()
+
+
+_DIGESTS_CACHE = collections.OrderedDict()
+_DIGESTS_CACHE_SIZE = 64
+_DIGESTS_LOCK = threading.Lock()
+
+
+def _digests_key(filename):
+    stat = os.stat(filename)
+    return filename, stat.st_size, stat.st_mtime_ns
+
+
+def known_file_digests(filename):
+    """Return the digests of a file if they were already computed
+    Returns: (str, str) - (blake2b, sha1) or None
+    """
+    key = _digests_key(filename)
+    with _DIGESTS_LOCK:
+        return _DIGESTS_CACHE.get(key)
+
+
+def remember_file_digests(filename, digests):
+    """Keep the digests of a file computed while uploading it"""
+    key = _digests_key(filename)
+    with _DIGESTS_LOCK:
+        _DIGESTS_CACHE[key] = digests
+        while len(_DIGESTS_CACHE) > _DIGESTS_CACHE_SIZE:
+            _DIGESTS_CACHE.popitem(last=False)
+
+
+def shared_file_digests(filename):
+    """Return the digests of a file like :func:`file_digests`, the file is
+    read only once when it is uploaded to several targets.
+    Returns: (str, str) - (blake2b, sha1)
+    """
+    digests = known_file_digests(filename)
+    if digests is None:
+        digests = file_digests(filename)
+        remember_file_digests(filename, digests)
+    return digests
+
+
+def timed(stage):
+    """Decorator recording the duration of a :class:`NextcloudUpload`
+    method in its metrics.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.timer(stage):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def backoff_delay(attempt, base=1.0, cap=60.0):
+    """Return the delay before a new attempt: exponential backoff with a
+    random jitter, so that retries of several clients (or threads) do not
+    hit the server at the same time.
+    :param attempt: number of attempts already failed (starting at 0)
+    :type attempt: int
+    :param base: delay in seconds after the first failure
+    :type base: float
+    :param cap: maximum delay in seconds
+    :type cap: float
+    Returns: float - delay in seconds, between half and the full backoff
+    """
+    delay = min(cap, base * 2 ** min(attempt, 32))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def make_web_rendition(source, destination, max_size, quality, fmt='jpeg'):
+    """Save a lightweight copy of a picture for web display (resized,
+    without EXIF data). Executed in a separate process.
+    Returns: float - CPU time in seconds
+    """
+    start = time.process_time()
+    with Image.open(source) as image:
+        # Let the JPEG decoder downscale while reading (much faster)
+        image.draft('RGB', (max_size, max_size))
+        image = image.convert('RGB')
+        image.thumbnail((max_size, max_size), Image.BICUBIC)
+        if fmt == 'webp':
+            image.save(destination, 'WEBP', quality=quality, method=4)
+        else:
+            image.save(destination, 'JPEG', quality=quality, optimize=True, progressive=True)
+    return time.process_time() - start
 
 
 ###########################################################################
@@ -235,6 +540,18 @@ class NextcloudUpload(object):
 
     app = None
 
+    CHUNK_RETRIES = 3
+    BACKLOG_THRESHOLD = 20
+    BACKLOG_YIELD_DELAY = 0.2
+    WEB_DIRNAME = '.nextcloud_web'
+    ORIGINALS_DIRNAME = 'Originals'
+    RAW_DIRNAME = 'raw'
+    SHARE_CACHE_FILENAME = '.nextcloud_share.json'
+    QR_CACHE_DIRNAME = '.nextcloud_qr'
+    SHARES_INDEX_TTL = 300
+
+    _share_cache_lock = threading.Lock()
+
     def __init__(self, credentials=None, activate=True):
         """Initialize NextcloudUpload instance
         :param credentials: file create at first run to keep allow API use
@@ -242,30 +559,435 @@ class NextcloudUpload(object):
         :param activate: use to disable the plugin
         :type activate: bool
         """
+        self.name = 'NEXTCLOUD'
+        self.primary = True
+        self.parent = None
+        self.targets = []
         self.is_connected = False
         self.last_error = None
         self.gallery_app = "photos"
         self.check_quota = True
         self.min_space_mb = 100
+        self.web_rendition = False
+        self.web_max_size = 1600
+        self.web_quality = 80
+        self.web_format = "jpeg"
+        self.renderers = None
+        self.chunk_size_mb = 10
+        self.upload_workers = 2
+        self.upload_queue_size = 200
+        self.album_base = None
+        self.gallery_index = False
+        self.gallery_index_url = ""
+        self.gallery = None
+        self.photo_qr = False
+        self.photo_shares = None
+        self.spool_dir = None
+        self.spool_max_mb = 1024
+        self.spool_retention_hours = 0
+        self.spool_evict_captures = False
+        self.spool = None
+        self.upload_raw = False
+        self.session_window = 1.0
+        self.sessions = None
+        self._remote_dirs = set()
+        self.album_rotation = 0
+        self.album_prefetch = 2
+        self._shares_index = None
+        self._shares_time = 0
+        self._shares_lock = threading.Lock()
+        self._provision_lock = threading.Lock()
+        self._drain_lock = threading.Lock()
+        self.upload_engine = "threads"
+        self.upload_concurrency = 16
+        self.workers = None
+        self.batch = None
+        self.journal = None
+        self._replay_needed = False
+        self._local = threading.local()
+        self._sync_lock = threading.Lock()
+        self.http = HttpPool()
+        self.throttle = TokenBucket()
+        self.metrics = Metrics()
+        self.metrics_exporter = None
+        self.quota = QuotaTracker(self._fetch_free_bytes)
+        self.monitor = ConnectivityMonitor(self.probe, self.on_online)
+        self.link = ""
+        self.link_gallery = None
+        self.qr_position = "top-left"
+        self.qr_size = 5
+        self.qr_margin = 10
+        self.qr_image = None
+        self.qr_ready = None
+        self._qr_files = {}  # filename: key of the QR code saved
+        self._qr_prepared = {}  # link_gallery: (surface, key) of the next albums
+        self._qr_display = None
+        self._qr_position_cache = None
 
-    def _is_internet(self):
-        """check internet connexion"""
+    def probe(self, timeout=5):
+        """Check that the Nextcloud server answers
+        Returns: bool - True if the server is reachable
+        """
         try:
-            requests.get('https://www.google.com/', timeout=5).status_code
-            return True
-        except (requests.ConnectionError, requests.Timeout):
-            LOGGER.warning("No internet connection!!!!")
+            response = self.http.request('GET', f"{self.nhost}/status.php", auth=None, timeout=timeout,
+                                         guarded=False)
+            online = response.status_code == 200 and response.json().get('installed', False)
+        except (requests.RequestException, ValueError) as e:
+            LOGGER.debug("Nextcloud server not reachable: %s", str(e))
             return False
+        if online:
+            self.http.breaker.network_restored()
+            if self._replay_needed and self.http.breaker.state != CircuitBreaker.CLOSED \
+                    and self.http.breaker.ready() and self.is_connected:
+                # Pictures postponed while the circuit was open
+                self.replay()
+        return online
+
+    def on_online(self):
+        """Called by the connectivity monitor when the server is reachable
+        again, and at each probe until the login succeeds
+        Returns: bool - True if connected
+        """
+        if not self.is_connected:
+            self.connect()
+        if self.is_connected:
+            if self.journal is not None and self.useSynchronize not in ('True', True) \
+                    and self.journal.count(UploadJournal.PENDING) > self.BACKLOG_THRESHOLD:
+                # Long task, the monitor goes on probing the server meanwhile
+                thread = threading.Thread(target=self.drain_backlog, name="NextcloudBacklog")
+                thread.daemon = True
+                thread.start()
+            else:
+                self.replay()
+        return self.is_connected
+
+    def drain_backlog(self, page_size=100):
+        """Upload the pending pictures of the journal in parallel batches,
+        then queue again the remaining ones
+        Returns: int - number of pictures uploaded
+        """
+        if not self._drain_lock.acquire(blocking=False):
+            return 0  # Already running
+        try:
+            uploaded = self._drain_backlog(page_size)
+        finally:
+            self._drain_lock.release()
+        self.replay()
+        return uploaded
+
+    def _drain_backlog(self, page_size):
+        LOGGER.info("Upload backlog of %d picture(s)", self.journal.count(UploadJournal.PENDING))
+        uploaded = 0
+        while self.monitor.online and self.workers is not None:
+            pending = self.journal.pending(page_size)
+            if not pending:
+                break
+            files = []
+            for local_source_file, remote_file, _ in pending:
+                if self._drop_missing(local_source_file):
+                    continue
+                self.journal.set_state(local_source_file, UploadJournal.QUEUED)
+                files.append((local_source_file, remote_file))
+            if not files:
+                continue
+            failed = self.upload_batch(files)
+            uploaded += len(files) - len(failed)
+            if len(failed) == len(files):
+                break
+        return uploaded
+
+    def upload_batch(self, files, max_concurrency=None):
+        """Upload several files concurrently, the number of parallel uploads
+        is adapted to the observed throughput and to the server load
+        (HTTP 429/503 responses). Progress is available in ``self.batch``.
+        :param files: list of (local_source_file, remote_file)
+        :type files: list
+        :param max_concurrency: maximum number of parallel uploads, the size
+                                of the HTTP pool by default
+        :type max_concurrency: int
+        Returns: list - (local_source_file, remote_file) which failed
+        """
+        if max_concurrency is None:
+            # More requests than pooled connections open throwaway connections
+            max_concurrency = max(1, self.http.pool_size)
+        sizes = {local: os.path.getsize(local) if os.path.isfile(local) else 0 for local, _ in files}
+        self.batch = progress = BatchProgress(sum(sizes.values()), len(files))
+        control = AdaptiveConcurrency(maximum=max_concurrency)
+        todo = list(files)
+        retries = {}
+        failed = []
+        running = set()
+
+        def upload(job):
+            start = time.time()
+            result = self.process_upload(*job)
+            return job, result, getattr(self._local, 'status', None), time.time() - start
+
+        with concurrent.futures.ThreadPoolExecutor(max_concurrency, "NextcloudBatch") as executor:
+            while todo or running:
+                while todo and len(running) < control.limit and not self._latest_waiting():
+                    running.add(executor.submit(upload, todo.pop(0)))
+                if not running:
+                    # The new captures are uploaded first
+                    time.sleep(self.BACKLOG_YIELD_DELAY)
+                    continue
+                done, running = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    job, result, status, elapsed = future.result()
+                    if result:
+                        control.success(sizes[job[0]], elapsed)
+                        progress.update(sizes[job[0]])
+                    elif status in (429, 503) and retries.get(job, 0) < 3:
+                        control.overloaded()
+                        retries[job] = retries.get(job, 0) + 1
+                        self.metrics.inc('retries_total', stage='batch')
+                        todo.append(job)
+                    else:
+                        failed.append(job)
+                        progress.update(sizes[job[0]], failed=True)
+                if progress.done % 10 == 0 or not (todo or running):
+                    LOGGER.info("Batch upload: %d/%d files, %.0f kB/s, %d parallel, ETA %.0fs", progress.done,
+                                progress.count, progress.throughput / 1024, control.limit, progress.eta)
+        return failed
+
+    def _latest_waiting(self):
+        """Return True if new captures are waiting in the upload queue"""
+        workers = self.workers
+        return workers is not None and workers.latest_waiting()
+
+    def connect(self):
+        """Login, check the disk quota, create the shared album directory and
+        prepare the QR code of the gallery link
+        Returns: str - link to the shared album (empty if the share failed)
+        """
+        self.oc = self.login(self.nhost, self.nuser, self.npassword)
+        if not self.is_connected:
+            if not self.link:
+                self.set_link_gallery("Non connecte")
+            return ""
+
+        # Check disk quota if enabled
+        if self.check_quota:
+            quota_ok, quota_msg = self.check_disk_quota()
+            if not quota_ok:
+                LOGGER.warning("Quota check failed: %s", quota_msg)
+                self.last_error = quota_msg
+
+        LOGGER.info("Create Link (%s)...", self.album_name)
+        link, error_msg = self.create_share_dir(self.rep_photos_nextcloud, self.album_name)
+        if error_msg:
+            self.last_error = error_msg
+
+        if not error_msg:
+            self._remote_dirs.add(self.rep_photos_nextcloud + self.album_name)
+        if self.web_rendition:
+            self._mkdir(self.rep_photos_nextcloud + self.album_name + '/' + self.ORIGINALS_DIRNAME)
+
+        if link:
+            self.link = link
+            self.set_link_gallery(self.create_url_gallery(link))
+            LOGGER.info("Create Link Gallery (%s)...", self.link_gallery)
+        elif not self.link:
+            LOGGER.warning("Could not create share link, using fallback")
+            self.set_link_gallery("Lien indisponible")
+
+        if self.album_rotation:
+            self.provision_upcoming()
+        return link
+
+    def set_link_gallery(self, link_gallery):
+        """Prepare the QR code of a new gallery link, it is displayed at
+        next entry in the wait state
+        """
+        if link_gallery != self.link_gallery:
+            self.link_gallery = link_gallery
+            if self.primary:
+                prepared = self._qr_prepared.get(link_gallery)
+                if prepared is not None:
+                    # Rendered in advance with the album
+                    surface, key = prepared
+                    self.qr_ready = surface
+                    if self._qr_files.get('QRCODE.png') != key:
+                        self._save_qr_file('QRCODE.png', key, Image.frombytes('RGB', surface.get_size(),
+                                                                              pygame.image.tostring(surface, 'RGB')))
+                else:
+                    self.qr_ready = self.render_qr(link_gallery)
+
+    def render_qr(self, data, filename='QRCODE.png', cache=True):
+        """Create the QR code image of the given data, the image is loaded
+        from the cache if it was already generated
+        :param filename: name of the PNG file of the pibooth directory
+                         updated with the image (None to skip)
+        :type filename: str
+        :param cache: keep the image in the disk cache (False for the QR
+                      codes displayed only once, kept in memory by the caller)
+        :type cache: bool
+        Returns: pygame.Surface - QR code image
+        """
+        qr_box_size = max(3, min(10, self.qr_size))
+        key = self._qr_key(data)
+        cache_file = os.path.join(self.local_rep, self.QR_CACHE_DIRNAME,
+                                  hashlib.sha1(key.encode('utf-8')).hexdigest() + '.rgb')
+        if cache:
+            try:
+                with open(cache_file, 'rb') as fp:
+                    size = struct.unpack('<II', fp.read(8))
+                    pixels = fp.read()
+                surface = pygame.image.fromstring(pixels, size, 'RGB')
+            except (OSError, struct.error, ValueError):
+                surface = None
+            if surface is not None:
+                if filename and self._qr_files.get(filename) != key:
+                    # The file may still hold the code of another link
+                    self._save_qr_file(filename, key, Image.frombytes('RGB', size, pixels))
+                return surface
 
-    def wait_for_internet_connection(self):
-        req = Request("http://google.com/")
-        for timeout in [1, 5, 10, 15]:
+        qr = qrcode.QRCode(version=1,
+                           error_correction=qrcode.constants.ERROR_CORRECT_L,
+                           box_size=qr_box_size,
+                           border=2)
+        qr.add_data(data)
+        qr.make(fit=True)
+        image = qr.make_image(fill_color="black", back_color="white").convert('RGB')
+        if filename:
+            self._save_qr_file(filename, key, image)
+
+        if cache:
             try:
-                response = urlopen(req, timeout=timeout)
-                return True
-            except URLError as err:
-                pass
-        return False
+                os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+                with open(cache_file + '.tmp', 'wb') as fp:
+                    fp.write(struct.pack('<II', *image.size))
+                    fp.write(image.tobytes())
+                os.replace(cache_file + '.tmp', cache_file)
+            except OSError as e:
+                LOGGER.warning("Could not save QR code in cache: %s", str(e))
+
+        LOGGER.info("QR code created with size=%d, position=%s, margin=%d",
+                    qr_box_size, self.qr_position, self.qr_margin)
+        return pygame.image.fromstring(image.tobytes(), image.size, image.mode)
+
+    def _qr_key(self, data):
+        """Return the key identifying the QR code image of the given data"""
+        # Clamp qr_size between 3 and 10
+        qr_box_size = max(3, min(10, self.qr_size))
+        return '|'.join((data, str(qr_box_size), '2', 'black', 'white'))
+
+    def _save_qr_file(self, filename, key, image):
+        """Save a QR code image in the pibooth directory"""
+        image.save(os.path.join(self.local_rep, filename), "PNG")
+        self._qr_files[filename] = key
+
+    def display_qr_image(self):
+        """Return the QR code image converted to the display pixel format
+        (fast blit), the conversion is done once per image
+        """
+        if self._qr_display is None or self._qr_display[0] is not self.qr_image:
+            self._qr_display = (self.qr_image, self.qr_image.convert())
+        return self._qr_display[1]
+
+    def qr_blit_position(self, win_size, qr_image=None):
+        """Return the position of a QR code (the gallery one by default) in a
+        window of the given size, computed once per window and image size
+        """
+        qr_size = (qr_image or self.qr_image).get_size()
+        key = (win_size, qr_size, self.qr_position, self.qr_margin)
+        if self._qr_position_cache is None or self._qr_position_cache[0] != key:
+            win_width, win_height = win_size
+            qr_width, qr_height = qr_size
+            margin = self.qr_margin
+            positions = {
+                "top-left": (margin, margin),
+                "top-right": (win_width - qr_width - margin, margin),
+                "bottom-left": (margin, win_height - qr_height - margin),
+                "bottom-right": (win_width - qr_width - margin, win_height - qr_height - margin),
+                "center": ((win_width - qr_width) // 2, (win_height - qr_height) // 2),
+            }
+            # Default to top-left
+            self._qr_position_cache = (key, positions.get(self.qr_position, (margin, margin)))
+        return self._qr_position_cache[1]
+
+    def _share_cache_key(self, album_name=None):
+        """Return the key of the share link of an album in the cache file"""
+        return '|'.join((self.nhost, self.nuser, self.rep_photos_nextcloud, album_name or self.album_name))
+
+    def _load_share_cache(self):
+        """Return the share links saved by previous runs"""
+        try:
+            with open(os.path.join(self.local_rep, self.SHARE_CACHE_FILENAME), encoding='utf-8') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_share_cache(self, links):
+        """Save the share links of albums for next runs
+        :param links: share link by album name
+        :type links: dict
+        """
+        with self._share_cache_lock:
+            cache = self._load_share_cache()
+            cache.update((self._share_cache_key(album_name), link) for album_name, link in links.items())
+            filename = os.path.join(self.local_rep, self.SHARE_CACHE_FILENAME)
+            try:
+                with open(filename + '.tmp', 'w', encoding='utf-8') as fp:
+                    json.dump(cache, fp, indent=2)
+                os.replace(filename + '.tmp', filename)
+            except OSError as e:
+                LOGGER.warning("Could not save share link cache: %s", str(e))
+
+    def cached_share_link(self, album_name=None):
+        """Return the share link of an album (the current one by default)
+        saved by a previous run
+        Returns: str - share link or empty string
+        """
+        return self._load_share_cache().get(self._share_cache_key(album_name), "")
+
+    def add_target(self, name, nhost, nuser, npassword, rep_photos_nextcloud, album_name, gallery_app="photos"):
+        """Add a server/album receiving a copy of each picture, with its own
+        connection, upload queue and journal so that a slow server does not
+        hold back the others. Bandwidth limit and metrics are shared.
+        :param name: name of the configuration section of the target
+        :type name: str
+        Returns: NextcloudUpload - the new target
+        """
+        target = NextcloudUpload()
+        target.name = name
+        target.primary = False
+        target.parent = self
+        target.nhost = nhost
+        target.nuser = nuser
+        target.npassword = npassword
+        target.rep_photos_nextcloud = rep_photos_nextcloud
+        target.album_base = album_name
+        target.gallery_app = gallery_app
+        for attr in ('activate_state', 'useSynchronize', 'local_rep', 'check_quota', 'min_space_mb',
+                     'album_rotation', 'album_prefetch', 'gallery_index', 'gallery_index_url',
+                     'web_rendition', 'chunk_size_mb', 'upload_workers', 'upload_queue_size',
+                     'upload_engine', 'upload_concurrency', 'upload_raw', 'session_window'):
+            setattr(target, attr, getattr(self, attr))
+        target.album_name = target.album_for()
+        target.quota.ttl = self.quota.ttl
+        target.monitor.interval = self.monitor.interval
+        target.http = HttpPool(self.http.pool_size, CircuitBreaker(self.http.breaker.threshold,
+                                                                   self.http.breaker.reset_delay))
+        target.throttle = self.throttle
+        target.metrics = self.metrics
+        target.link = target.cached_share_link()
+        self.targets.append(target)
+        LOGGER.info("Add Nextcloud target [%s] (%s%s%s)", name, nhost, rep_photos_nextcloud, album_name)
+        return target
+
+    def remote_path(self, filename, album_name=None):
+        """Return the path on the server of a file of an album (the current
+        one by default)
+        """
+        return self.rep_photos_nextcloud + (album_name or self.album_name) + '/' + filename
+
+    def is_album_picture(self, remote_file):
+        """Return True if the file is at the root of an album, not an
+        original, a raw capture or a file of the gallery index
+        """
+        return remote_file.startswith(self.rep_photos_nextcloud) \
+            and remote_file[len(self.rep_photos_nextcloud):].count('/') == 1
 
     def login(self, nhost, nuser, npassword):
         """Perform actions when state is activated
@@ -277,15 +999,18 @@ class NextcloudUpload(object):
         LOGGER.info("Login Host (%s)...", self.nhost)
         LOGGER.info("Login User (%s)...", self.nuser)
 
-        oc = owncloud.Client(nhost, single_session=True)
+        self.http.auth = (nuser, npassword)
+        oc = pooled_client(nhost, self.http, single_session=True)
 
         try:
             oc.login(nuser, npassword)
             self.is_connected = True
             self.oc = oc
+            self._local.oc = oc
             LOGGER.info("Nextcloud Login OK !! (%s)", nhost)
         except owncloud.HTTPResponseError as e:
             self.is_connected = False
+            self.metrics.inc('errors_total', stage='login', status=str(e.status_code))
             if e.status_code == 401:
                 self.last_error = "Identifiants incorrects"
                 LOGGER.error("Nextcloud authentication failed: invalid credentials")
@@ -299,86 +1024,530 @@ class NextcloudUpload(object):
 
         return oc if self.is_connected else None
 
+    def _get_client(self):
+        """Return the owncloud client owned by the calling thread.
+
+        Each upload worker opens its own session so that concurrent
+        requests never share the state of a single client.
+        """
+        oc = getattr(self._local, 'oc', None)
+        if oc is None:
+            oc = pooled_client(self.nhost, self.http, single_session=True)
+            oc.login(self.nuser, self.npassword)
+            self._local.oc = oc
+        return oc
+
+    def start_workers(self):
+        """Open the upload journal and start the background upload workers"""
+        if self.journal is None:
+            filename = UploadJournal.FILENAME
+            if not self.primary:
+                filename = filename.replace('.db', '.' + self.name.lower() + '.db')
+            self.journal = UploadJournal(os.path.join(self.local_rep, filename))
+            self.journal.recover()
+        if self.workers is None:
+            if self.upload_engine == 'asyncio':
+                self.workers = AsyncUploadEngine(self, self.upload_concurrency, self.upload_queue_size)
+            else:
+                self.workers = UploadWorkerPool(self, self.upload_workers, self.upload_queue_size)
+            self.workers.start()
+        if self.session_window > 0 and self.sessions is None:
+            self.sessions = SessionBatcher(self, self.session_window)
+        if self.spool_dir and self.primary and self.spool is None:
+            self.spool = SpoolManager(self, self.spool_dir, self.spool_max_mb * 1024 * 1024,
+                                      self.spool_retention_hours * 3600, self.spool_evict_captures)
+            for target in self.targets:
+                target.spool = self.spool
+        if self.photo_qr and self.primary and self.photo_shares is None:
+            self.photo_shares = PhotoShares(self)
+            self.photo_shares.start()
+        if self.gallery_index and self.gallery is None:
+            self.gallery = GalleryIndex(self)
+            self.gallery.start()
+        if (self.web_rendition or self.gallery_index) and self.primary and self.renderers is None:
+            # Shared by the web renditions and the thumbnails of all the targets
+            if self.web_rendition:
+                os.makedirs(os.path.join(self.local_rep, self.WEB_DIRNAME), exist_ok=True)
+            self._start_renderers()
+
+    def _start_renderers(self):
+        """Create the pool of processes generating the web renditions and the
+        thumbnails, the processes are started in background and not at the
+        first capture
+        """
+        # Processes are not forked from the upload threads and the open journals
+        method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+        renderers = concurrent.futures.ProcessPoolExecutor(os.cpu_count(),
+                                                           mp_context=multiprocessing.get_context(method))
+        self.renderers = renderers
+
+        def warm_up():
+            try:
+                for future in [renderers.submit(os.getpid) for _ in range(os.cpu_count() or 1)]:
+                    future.result()
+            except Exception as e:
+                LOGGER.warning("Could not start the web rendition processes: %s", str(e))
+
+        thread = threading.Thread(target=warm_up, name="NextcloudRenderers")
+        thread.daemon = True
+        thread.start()
+
+    def render(self, function, *args):
+        """Run a rendering function in the pool of processes of the primary
+        server, or in the calling thread if the pool is not available
+        Returns: result of the function
+        """
+        owner = self.parent or self
+        renderers = owner.renderers
+        if renderers is not None:
+            try:
+                return renderers.submit(function, *args).result()
+            except RuntimeError as e:
+                # Pool broken (a process was killed) or shut down
+                LOGGER.warning("Rendering processes not available, render in this thread: %s", str(e))
+                if owner.renderers is renderers and owner.workers is not None:
+                    renderers.shutdown(wait=False)
+                    owner._start_renderers()
+        return function(*args)
+
+    def stop_workers(self, timeout=5):
+        """Stop the background upload workers and close the upload journal"""
+        if self.spool is not None and self.primary:
+            self.spool.stop(timeout)
+        if self.gallery is not None:
+            self.gallery.stop(timeout)
+            self.gallery = None
+        if self.renderers is not None:
+            self.renderers.shutdown(wait=False)
+            self.renderers = None
+        if self.photo_shares is not None:
+            self.photo_shares.stop(timeout)
+            self.photo_shares = None
+        if self.sessions is not None:
+            self.sessions.flush()
+            self.sessions = None
+        if self.workers is not None:
+            self.workers.stop(timeout)
+            if isinstance(self.workers, AsyncUploadEngine):
+                LOGGER.info("asyncio HTTP connections: %d opened, %d reused", *self.workers.client.stats())
+            self.workers = None
+        self.spool = None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        opened, reused = self.http.stats()
+        LOGGER.info("HTTP connections: %d opened, %d reused", opened, reused)
+
+    def enqueue(self, local_source_file, remote_file, priority=None):
+        """Queue a picture for upload, never blocks the caller
+        :param local_source_file: Path to local file to upload
+        :type local_source_file: str
+        :param remote_file: path of the file on Nextcloud
+        :type remote_file: str
+        :param priority: one of the UploadWorkerPool priority classes
+        :type priority: int
+        """
+        if self.workers is None:
+            LOGGER.warning("Upload workers not started, picture not queued (%s)", local_source_file)
+            return False
+        if priority is None:
+            priority = UploadWorkerPool.LATEST
+        self.journal.add(local_source_file, remote_file, UploadJournal.QUEUED, priority)
+        if self.sessions is not None and priority in self.workers.SESSION_PRIORITIES:
+            # Grouped with the files of the same priority class queued right after
+            self.sessions.add(local_source_file, remote_file, priority)
+            return True
+        if not self.workers.put(local_source_file, remote_file, priority):
+            # Kept as pending in the journal, queued again on next replay
+            self.journal.set_state(local_source_file, UploadJournal.PENDING)
+            self.last_error = "File d'attente pleine"
+            self._replay_needed = True
+            return False
+        return True
+
+    def enqueue_session(self, session):
+        """Queue the files of a session to be uploaded together, called by
+        the :class:`SessionBatcher` when its window is elapsed
+        :param session: files to upload
+        :type session: :class:`UploadSession`
+        """
+        if self.workers is None or not self.workers.put_session(session):
+            for local_source_file, _ in session.files():
+                self.journal.set_state(local_source_file, UploadJournal.PENDING)
+            self.last_error = "File d'attente pleine"
+            self._replay_needed = True
+            return False
+        return True
+
+    def enqueue_picture(self, local_source_file, remote_file, raw_files=(), capture_time=None):
+        """Queue a new capture for upload to all the targets, a lightweight
+        copy is uploaded first if web renditions are enabled, never blocks
+        the caller
+        :param local_source_file: Path to local file to upload
+        :type local_source_file: str
+        :param remote_file: path of the file on Nextcloud
+        :type remote_file: str
+        :param raw_files: raw captures uploaded in a sub-folder of the album
+        :type raw_files: list
+        :param capture_time: time of the capture choosing the album of the
+                             other targets (now by default)
+        :type capture_time: float
+        """
+        remote_dir, filename = os.path.split(remote_file)
+        destinations = [(self, remote_dir)]
+        for target in self.targets:
+            destinations.append((target, target.remote_path('', target.album_for(capture_time)).rstrip('/')))
+
+        if self.useSynchronize == 'True' or self.useSynchronize == True:
+            return all([target.enqueue(local_source_file, '/'.join((target_dir, filename)))
+                        for target, target_dir in destinations])
+
+        if self.spool is not None:
+            # Kept in the spool until it is uploaded everywhere, the link (or
+            # copy) is done in background and not in the pibooth hook
+            self.spool.add_later(local_source_file,
+                                 lambda spool_file: self._enqueue_copies(spool_file, filename, destinations,
+                                                                         raw_files))
+            return True
+        return self._enqueue_copies(local_source_file, filename, destinations, raw_files)
+
+    def _enqueue_copies(self, local_source_file, filename, destinations, raw_files=()):
+        """Queue a new capture for upload to all the targets, with its web
+        rendition and its raw captures
+        :param destinations: list of (target, remote_dir)
+        :type destinations: list
+        """
+
+        def enqueue_raw_files():
+            # Uploaded with the originals, in a folder per capture
+            for raw_file in raw_files:
+                raw_dir, raw_filename = os.path.split(raw_file)
+                for target, target_dir in destinations:
+                    target.enqueue(raw_file, '/'.join((target_dir, self.RAW_DIRNAME, os.path.basename(raw_dir),
+                                                       raw_filename)), UploadWorkerPool.ORIGINAL)
+
+        ext = '.webp' if self.web_format == 'webp' else '.jpg'
+        web_filename = os.path.splitext(filename)[0] + ext
+        web_file = os.path.join(self.local_rep, self.WEB_DIRNAME, web_filename)
+        future = None
+        renderers = self.renderers if self.web_rendition else None
+        if renderers is not None:
+            try:
+                future = renderers.submit(make_web_rendition, local_source_file, web_file,
+                                          self.web_max_size, self.web_quality, self.web_format)
+            except RuntimeError as e:
+                # Pool broken (a process was killed) or shut down
+                LOGGER.warning("Web rendition of %s not possible, upload the original: %s",
+                               local_source_file, str(e))
+                if self.renderers is renderers and self.workers is not None:
+                    renderers.shutdown(wait=False)
+                    self._start_renderers()
+
+        if future is None:
+            queued = all([target.enqueue(local_source_file, '/'.join((target_dir, filename)))
+                          for target, target_dir in destinations])
+            enqueue_raw_files()
+            return queued
+
+        def rendition_done(future):
+            try:
+                cpu_time = future.result()
+                LOGGER.info("Web rendition of %s: %d -> %d bytes in %.2fs CPU", local_source_file,
+                            os.path.getsize(local_source_file), os.path.getsize(web_file), cpu_time)
+                if self.spool is not None:
+                    self.spool.register(web_file)
+            except Exception as e:
+                LOGGER.warning("Web rendition of %s failed, upload the original: %s", local_source_file, str(e))
+                for target, target_dir in destinations:
+                    target.enqueue(local_source_file, '/'.join((target_dir, filename)))
+                enqueue_raw_files()
+                return
+            for target, target_dir in destinations:
+                target.enqueue(web_file, '/'.join((target_dir, web_filename)))
+                # The original is uploaded after all the lightweight copies
+                target.enqueue(local_source_file, '/'.join((target_dir, self.ORIGINALS_DIRNAME, filename)),
+                               UploadWorkerPool.ORIGINAL)
+            enqueue_raw_files()
+
+        future.add_done_callback(rendition_done)
+        return True
+
+    def _drop_missing(self, local_source_file):
+        """Remove from the pending uploads a picture deleted from the disk
+        Returns: bool - True if the picture is missing
+        """
+        if os.path.isfile(local_source_file):
+            return False
+        LOGGER.warning("Pending picture not found, dropped from journal (%s)", local_source_file)
+        self.journal.set_state(local_source_file, UploadJournal.DONE)
+        return True
+
+    def replay(self):
+        """Queue again the pictures recorded as pending in the journal
+        Returns: int - number of pictures queued
+        """
+        if self.workers is None:
+            return 0
+        self._replay_needed = False
+        count = 0
+        for local_source_file, remote_file, priority in self.journal.pending(self.workers.free_slots()):
+            if self._drop_missing(local_source_file):
+                continue
+            self.journal.set_state(local_source_file, UploadJournal.QUEUED)
+            if not self.workers.put(local_source_file, remote_file, max(priority, UploadWorkerPool.BACKLOG)):
+                self.journal.set_state(local_source_file, UploadJournal.PENDING)
+                self._replay_needed = True
+                break
+            count += 1
+        if count:
+            LOGGER.info("Resume upload of %d pending picture(s)", count)
+        return count
+
+    def process_upload(self, local_source_file, remote_file):
+        """Upload a queued picture, called from an upload worker
+        :param local_source_file: Path to local file to upload
+        :type local_source_file: str
+        :param remote_file: path of the file on Nextcloud
+        :type remote_file: str
+        """
+        self.journal.set_state(local_source_file, UploadJournal.IN_FLIGHT)
+        uploaded = self._upload_queued(local_source_file, remote_file)
+        self._upload_finished(local_source_file, remote_file, uploaded)
+        return uploaded
+
+    def process_session(self, session):
+        """Upload the files of a session, called from an upload worker
+        :param session: files to upload
+        :type session: :class:`UploadSession`
+        """
+        files = session.files()
+        for local_source_file, _ in files:
+            self.journal.set_state(local_source_file, UploadJournal.IN_FLIGHT)
+        results = dict.fromkeys((local_source_file for local_source_file, _ in files), False)
+        try:
+            if self.useSynchronize == 'True' or self.useSynchronize == True:
+                # A single synchronization of the directory for all the files
+                uploaded = self._upload_queued(*files[-1])
+                results.update(dict.fromkeys(results, uploaded))
+            else:
+                self.upload_session(files, results)
+        finally:
+            # Always leave the in-flight state, even on unexpected error
+            for local_source_file, remote_file in files:
+                self._upload_finished(local_source_file, remote_file, results[local_source_file])
+        return all(results.values())
+
+    @timed('upload_session')
+    def upload_session(self, files, results=None):
+        """Upload several files one after the other on the connection of the
+        calling thread. The missing folders are created once, and the
+        content of the folders of raw captures (sizes and ETags) and the free
+        space are checked with a single request at the end.
+        :param files: list of (local_source_file, remote_file)
+        :type files: list
+        :param results: dict updated with the result of each file as soon as known
+        :type results: dict
+        Returns: dict - True for each local file uploaded
+        """
+        if results is None:
+            results = {}
+        results.update(dict.fromkeys((local_source_file for local_source_file, _ in files), False))
+        if not self._quota_allows_upload() or not self._can_upload(self.activate_state):
+            return results
+
+        folders = sorted(set(os.path.dirname(remote_file) for _, remote_file in files))
+        for remote_dir in folders:
+            self._makedirs(remote_dir)
+
+        sizes = {}
+        for local_source_file, remote_file in files:
+            if self.upload_photos(local_source_file, remote_file, self.activate_state):
+                results[local_source_file] = True
+                sizes[remote_file] = os.path.getsize(local_source_file)
+                self.quota.consume(sizes[remote_file])
+
+        # Final check of the folders of raw captures, only holding files of the session
+        for remote_dir in folders:
+            if os.path.basename(os.path.dirname(remote_dir)) != self.RAW_DIRNAME:
+                continue
+            try:
+                props = self._propfind(self._dav_url(remote_dir),
+                                       ['getcontentlength', 'getetag', 'quota-available-bytes'], depth=1)
+            except Exception as e:
+                # Keep the result of each upload, the check is only a safety net
+                LOGGER.warning("Upload session: cannot list remote directory: %s", str(e))
+                props = None
+            if props is None:
+                continue
+            found = {}
+            for href, values in props.items():
+                if href.rstrip('/').endswith(remote_dir.rstrip('/')):
+                    # The folder itself, its free space is the one of the user
+                    if self.check_quota and values.get('quota-available-bytes'):
+                        self.quota.update(int(values['quota-available-bytes']))
+                else:
+                    found[os.path.basename(href.rstrip('/'))] = values
+            for local_source_file, remote_file in files:
+                if os.path.dirname(remote_file) != remote_dir or not results[local_source_file]:
+                    continue
+                values = found.get(os.path.basename(remote_file), {})
+                if not values.get('getetag') or values.get('getcontentlength') != str(sizes[remote_file]):
+                    LOGGER.warning("Uploaded file not found on server, upload again later (%s)", remote_file)
+                    self.journal.delete_content(remote_file)
+                    results[local_source_file] = False
+        LOGGER.info("Upload session: %d/%d file(s) in %d folder(s)", sum(results.values()), len(files), len(folders))
+        return results
+
+    def _upload_finished(self, local_source_file, remote_file, uploaded):
+        """Record the result of a queued upload in the journal"""
+        if uploaded:
+            self.journal.set_state(local_source_file, UploadJournal.DONE)
+            if self.gallery is not None:
+                self.gallery.add(local_source_file, remote_file)
+            if self.photo_shares is not None:
+                self.photo_shares.add(local_source_file, remote_file)
+            if self.spool is not None:
+                self.spool.evict_later()
+            if self._replay_needed:
+                self.replay()
+        else:
+            self.journal.set_state(local_source_file, UploadJournal.PENDING, failed=True)
+            self._replay_needed = True
+
+    def _quota_allows_upload(self):
+        """Check the last known free space on the server before an upload"""
+        if self.is_connected and self.check_quota:
+            quota_ok, quota_msg = self.quota.check(self.min_space_mb)
+            if not quota_ok:
+                LOGGER.error("Cannot upload: %s", quota_msg)
+                self.last_error = quota_msg
+                return False
+        return True
+
+    def _upload_queued(self, local_source_file, remote_file):
+        """Check quota then upload or synchronize the picture"""
+        # Check quota before upload if enabled
+        if not self._quota_allows_upload():
+            return False
+
+        if self.useSynchronize == 'True' or self.useSynchronize == True:
+            if not self._circuit_allows_upload():
+                return False
+            LOGGER.info("Synchronize Directory local to Remote (%s)...", local_source_file)
+            # Album of the capture, not necessarily the current one
+            album_name = remote_file[len(self.rep_photos_nextcloud):].split('/')[0]
+            with self._sync_lock:
+                return self.synchronize_pics(self.local_rep, self.rep_photos_nextcloud, album_name)
+
+        LOGGER.info("Upload Photo (%s)...", local_source_file)
+        if self.upload_photos(local_source_file, remote_file, self.activate_state):
+            self.quota.consume(os.path.getsize(local_source_file))
+            return True
+        return False
+
     def check_disk_quota(self):
-        """Check available disk space on Nextcloud
+        """Check available disk space on Nextcloud (request the server)
         Returns: (bool, str) - (is_ok, message)
         """
         if not self.is_connected:
             return False, "Non connecte"
 
+        self.quota.refresh()
+        return self.quota.check(self.min_space_mb)
+
+    @timed('check_disk_quota')
+    def _fetch_free_bytes(self):
+        """Request the free space of the user on the server
+        Returns: int - free bytes (negative if unlimited) or None if unknown
+        """
         try:
             # Get user quota information
-            user_info = self.oc.get_attribute('quota')
+            user_info = self._get_client().get_attribute('quota')
 
-            if user_info is None:
+            if not isinstance(user_info, dict):
                 # Try alternative method using WebDAV
-                return self._check_quota_webdav()
-
-            free_bytes = user_info.get('free', 0)
-            free_mb = free_bytes / (1024 * 1024)
-
-            if free_mb < self.min_space_mb:
-                return False, f"Espace insuffisant: {free_mb:.0f}MB libre (min: {self.min_space_mb}MB)"
+                return self._fetch_free_bytes_webdav()
 
-            LOGGER.info("Disk quota OK: %.0f MB free", free_mb)
-            return True, f"{free_mb:.0f}MB libre"
+            return user_info.get('free', 0)
 
         except Exception as e:
             LOGGER.warning("Could not check quota: %s", str(e))
-            # Don't block if we can't check quota
-            return True, "Quota non verifie"
+            return None
+
+    def _dav_url(self, remote_path):
+        """Return the WebDAV URL of a path in the user files"""
+        return f"{self.nhost}/remote.php/dav/files/{quote(self.nuser)}/{quote(remote_path.lstrip('/'))}"
+
+    def _propfind(self, url, props, depth=0):
+        """Perform a WebDAV PROPFIND request
+        :param url: WebDAV URL of the resource
+        :type url: str
+        :param props: names of the DAV properties to retrieve
+        :type props: list
+        :param depth: 0 for the resource only, 1 to include its children
+        :type depth: int
+        Returns: dict - {href: {prop: value}} or None if the request failed
+        """
+        body = ('<?xml version="1.0"?><d:propfind xmlns:d="DAV:"><d:prop>'
+                + ''.join(f'<d:{prop}/>' for prop in props)
+                + '</d:prop></d:propfind>')
+
+        response = self.http.request(
+            'PROPFIND',
+            url,
+            headers={'Depth': str(depth)},
+            data=body,
+            timeout=10
+        )
+
+        if response.status_code != 207:
+            LOGGER.warning("PROPFIND %s returned HTTP %s", url, response.status_code)
+            return None
 
-    def _check_quota_webdav(self):
-        """Alternative quota check using WebDAV PROPFIND"""
+        ns = {'d': 'DAV:'}
+        result = {}
+        for element in ET.fromstring(response.content).findall('d:response', ns):
+            href = unquote(element.findtext('d:href', '', ns))
+            values = {}
+            for prop in props:
+                node = element.find(f'.//d:{prop}', ns)
+                if node is not None and node.text:
+                    values[prop] = node.text
+            result[href] = values
+        return result
+
+    def _fetch_free_bytes_webdav(self):
+        """Alternative quota request using WebDAV PROPFIND"""
         try:
-            import xml.etree.ElementTree as ET
-
-            url = f"{self.nhost}/remote.php/dav/files/{self.nuser}/"
-            headers = {'Depth': '0'}
-            body = '''<?xml version="1.0"?>
-            <d:propfind xmlns:d="DAV:">
-                <d:prop>
-                    <d:quota-available-bytes/>
-                    <d:quota-used-bytes/>
-                </d:prop>
-            </d:propfind>'''
-
-            response = requests.request(
-                'PROPFIND',
-                url,
-                auth=(self.nuser, self.npassword),
-                headers=headers,
-                data=body,
-                timeout=10
-            )
-
-            if response.status_code == 207:
-                # Parse XML response
-                root = ET.fromstring(response.content)
-                ns = {'d': 'DAV:'}
-
-                available = root.find('.//d:quota-available-bytes', ns)
-                used = root.find('.//d:quota-used-bytes', ns)
-
-                if available is not None and available.text:
-                    free_bytes = int(available.text)
-                    if free_bytes < 0:  # -3 means unlimited
-                        return True, "Quota illimite"
-
-                    free_mb = free_bytes / (1024 * 1024)
-
-                    if free_mb < self.min_space_mb:
-                        return False, f"Disque plein: {free_mb:.0f}MB libre"
-
-                    LOGGER.info("Disk quota OK (WebDAV): %.0f MB free", free_mb)
-                    return True, f"{free_mb:.0f}MB libre"
+            result = self._propfind(self._dav_url('/'), ['quota-available-bytes', 'quota-used-bytes'])
 
-            return True, "Quota non verifie"
+            if result:
+                available = list(result.values())[0].get('quota-available-bytes')
+                if available:
+                    return int(available)  # -3 means unlimited
 
         except Exception as e:
             LOGGER.warning("WebDAV quota check failed: %s", str(e))
-            return True, "Quota non verifie"
+        return None
+
+    def _mkdir(self, remote_dir):
+        """Create a remote directory, do nothing if it already exists
+        Returns: bool - True if the directory exists
+        """
+        try:
+            self._get_client().mkdir(remote_dir)
+            LOGGER.info("Successfully created the directory (%s)", remote_dir)
+        except owncloud.HTTPResponseError as e:
+            if e.status_code != 405:
+                LOGGER.warning("Creation of the directory (%s) returned %s", remote_dir, e.status_code)
+                return False
+        except Exception as e:
+            LOGGER.warning("Creation of the directory (%s) failed: %s", remote_dir, str(e))
+            return False
+        self._remote_dirs.add(remote_dir.rstrip('/'))
+        return True
 
+    @timed('create_share_dir')
     def create_share_dir(self, rep_photos_nextcloud, album_name):
         """Create directory to Cloud and Share
         Returns: (link, error_message)
@@ -393,7 +1562,7 @@ class NextcloudUpload(object):
 
         # Create base directory
         try:
-            self.oc.mkdir(self.rep_photos_nextcloud)
+            self._get_client().mkdir(self.rep_photos_nextcloud)
             LOGGER.info("Successfully created rep_photos_nextcloud !! (%s)", self.rep_photos_nextcloud)
         except owncloud.HTTPResponseError as e:
             if e.status_code == 405:
@@ -409,7 +1578,7 @@ class NextcloudUpload(object):
 
         # Create Album directory
         try:
-            self.oc.mkdir(self.rep_photos_nextcloud + album_name)
+            self._get_client().mkdir(self.rep_photos_nextcloud + album_name)
             LOGGER.info("Successfully created the directory (%s)", self.rep_photos_nextcloud + album_name)
         except owncloud.HTTPResponseError as e:
             if e.status_code == 405:
@@ -428,18 +1597,22 @@ class NextcloudUpload(object):
 
         LOGGER.info("Nextcloud Create Share Link (%s)", self.rep_photos_nextcloud + album_name)
 
+        link = self.cached_share_link()
+        if link:
+            LOGGER.info("Share Link found in cache (%s)", link)
+            return link, error_msg
+
         # Check if share already exists
-        try:
-            existing_shares = self.oc.get_shares(self.rep_photos_nextcloud + album_name)
-            if existing_shares:
-                LOGGER.info("Share Link Already Exists (%s)", self.rep_photos_nextcloud + album_name)
-                return existing_shares[0].get_link(), error_msg
-        except Exception as e:
-            LOGGER.info("No existing share found, creating new one")
+        link = self._share_links().get(self.rep_photos_nextcloud + album_name)
+        if link:
+            LOGGER.info("Share Link Already Exists (%s)", self.rep_photos_nextcloud + album_name)
+            self._save_share_cache({album_name: link})
+            return link, error_msg
 
         # Create new share link
         try:
-            link_info = self.oc.share_file_with_link(self.rep_photos_nextcloud + album_name, public_upload=False)
+            link_info = self._get_client().share_file_with_link(self.rep_photos_nextcloud + album_name, public_upload=False)
+            self._save_share_cache({album_name: link_info.get_link()})
             return link_info.get_link(), error_msg
         except owncloud.HTTPResponseError as e:
             if e.status_code == 404:
@@ -458,6 +1631,166 @@ class NextcloudUpload(object):
             return "", error_msg
 
 
+    def _share_links(self, refresh=False):
+        """Return the public links shared by the user indexed by path, they
+        are listed with a single request and kept ``SHARES_INDEX_TTL`` seconds
+        Returns: dict - link by path
+        """
+        with self._shares_lock:
+            if refresh or self._shares_index is None or time.time() - self._shares_time > self.SHARES_INDEX_TTL:
+                # Parsed here: the share listing of pyocclient fails on Python 3.9+
+                try:
+                    response = self.http.request('GET', f"{self.nhost}/ocs/v1.php/apps/files_sharing/api/v1/shares",
+                                                 headers={'OCS-APIRequest': 'true'})
+                    if response.status_code != 200:
+                        raise owncloud.HTTPResponseError(response)
+                    elements = ET.fromstring(response.content).iter('element')
+                except Exception as e:
+                    LOGGER.warning("Could not list the shares: %s", str(e))
+                    return self._shares_index or {}
+                self._shares_index = {element.findtext('path', '').rstrip('/'): element.findtext('url')
+                                      for element in elements
+                                      if element.findtext('share_type') == '3' and element.findtext('url')}
+                self._shares_time = time.time()
+            return self._shares_index
+
+    def _mkcol(self, remote_dir):
+        """Create a remote directory in a single request, thread-safe
+        Returns: bool - True if the directory exists
+        """
+        try:
+            response = self.http.request('MKCOL', self._dav_url(remote_dir))
+        except (requests.RequestException, CircuitOpenError) as e:
+            LOGGER.warning("Creation of the directory (%s) failed: %s", remote_dir, str(e))
+            return False
+        if response.status_code not in (201, 405):
+            LOGGER.warning("Creation of the directory (%s) returned %s", remote_dir, response.status_code)
+            return False
+        self._remote_dirs.add(remote_dir.rstrip('/'))
+        return True
+
+    def _makedirs(self, remote_dir):
+        """Create a remote directory and its missing parents below the
+        photos directory, the directories known to exist are skipped
+        Returns: bool - True if the directory exists
+        """
+        missing = []
+        remote_dir = remote_dir.rstrip('/')
+        while remote_dir and remote_dir not in self._remote_dirs \
+                and remote_dir + '/' != self.rep_photos_nextcloud:
+            missing.append(remote_dir)
+            remote_dir = os.path.dirname(remote_dir)
+        return all(self._mkcol(remote_dir) for remote_dir in reversed(missing))
+
+    @timed('provision_albums')
+    def provision_albums(self, album_names, max_concurrency=None):
+        """Create several albums and their share links in one pass: the
+        directories are created in parallel and the existing shares are
+        listed with a single request.
+        :param album_names: names of the albums to create
+        :type album_names: list
+        :param max_concurrency: maximum number of parallel requests, the size
+                                of the HTTP pool by default
+        :type max_concurrency: int
+        Returns: dict - share link by album name (empty string if failed)
+        """
+        if max_concurrency is None:
+            max_concurrency = max(1, self.http.pool_size)
+        album_names = list(album_names)
+        cache = self._load_share_cache()
+        links = {name: cache.get(self._share_cache_key(name), "") for name in album_names}
+        if not album_names:
+            return links
+        paths = [self.rep_photos_nextcloud + name for name in album_names]
+
+        self._mkcol(self.rep_photos_nextcloud)
+        with concurrent.futures.ThreadPoolExecutor(min(max_concurrency, len(paths))) as pool:
+            exists = list(pool.map(self._mkcol, paths))
+            if self.web_rendition:
+                list(pool.map(self._mkcol, ['/'.join((path, self.ORIGINALS_DIRNAME)) for path in paths]))
+
+        if not all(links.values()):
+            index = self._share_links(refresh=True)
+            for name, path in zip(album_names, paths):
+                links[name] = links[name] or index.get(path, "")
+        for name, path, created in zip(album_names, paths, exists):
+            if not links[name] and created:
+                try:
+                    links[name] = self._get_client().share_file_with_link(path, public_upload=False).get_link()
+                except Exception as e:
+                    LOGGER.warning("Failed to create share link of %s: %s", name, str(e))
+
+        self._save_share_cache({name: link for name, link in links.items() if link})
+        LOGGER.info("Provisioned %d album(s): %s", len(album_names), ', '.join(album_names))
+        return links
+
+    def album_for(self, timestamp=None):
+        """Return the name of the album of the rotation period including the
+        given time (now by default)
+        """
+        if not self.album_rotation:
+            return self.album_base
+        return self.album_base + time.strftime('_%Y-%m-%d_%Hh%M', time.localtime(self.album_period(timestamp)))
+
+    def album_period(self, timestamp=None):
+        """Return the start time of the rotation period including the given
+        time (now by default), 0 if albums are not rotated
+        """
+        if not self.album_rotation:
+            return 0
+        period = self.album_rotation * 60
+        return int((time.time() if timestamp is None else timestamp) // period * period)
+
+    def upcoming_albums(self):
+        """Return the names of the current and of the next albums"""
+        if not self.album_rotation:
+            return [self.album_name]
+        now = time.time()
+        return [self.album_for(now + index * self.album_rotation * 60)
+                for index in range(self.album_prefetch + 1)]
+
+    def rotate_album(self, album_name):
+        """Upload the next captures to another album, instant if the album
+        was provisioned, else it is created in background
+        Returns: bool - True if the share link of the album is known
+        """
+        LOGGER.info("Rotate to album (%s)", album_name)
+        self.album_name = album_name
+        self.link = self.cached_share_link()
+        if self.link:
+            self.set_link_gallery(self.create_url_gallery(self.link))
+        else:
+            self.set_link_gallery("Lien indisponible")
+        if self.is_connected:
+            thread = threading.Thread(target=self.provision_upcoming, name="NextcloudProvision")
+            thread.daemon = True
+            thread.start()
+        return bool(self.link)
+
+    def provision_upcoming(self):
+        """Create the current and the next albums, then update the link of
+        the current album if it was not known
+        """
+        if not self._provision_lock.acquire(blocking=False):
+            return
+        try:
+            album_name = self.album_name
+            links = self.provision_albums(self.upcoming_albums())
+            if self.primary:
+                # QR codes of the next albums, rotating is then only a swap
+                prepared = {}
+                for link in links.values():
+                    link_gallery = self.create_url_gallery(link)
+                    if link_gallery:
+                        prepared[link_gallery] = self._qr_prepared.get(link_gallery) \
+                            or (self.render_qr(link_gallery, filename=None), self._qr_key(link_gallery))
+                self._qr_prepared = prepared
+            if not self.link and links.get(album_name) and album_name == self.album_name:
+                self.link = links[album_name]
+                self.set_link_gallery(self.create_url_gallery(self.link))
+        finally:
+            self._provision_lock.release()
+
     def create_url_gallery(self, link):
         """Create URL for Gallery/Photos app based on configuration
 
@@ -465,6 +1798,11 @@ class NextcloudUpload(object):
         - direct: https://nextcloud.domain/s/shareToken (default, most reliable)
         - photos: https://nextcloud.domain/apps/photos/public/shareToken
         - gallery: https://nextcloud.domain/apps/gallery/s/shareToken (legacy)
+
+        With ``gallery_index``, the ``gallery_index_url`` (if any) is used
+        instead: Nextcloud sends the files of the public shares as
+        attachments, so the index page is only displayed by a server
+        configured for it.
         """
         if not link:
             return link
@@ -478,6 +1816,9 @@ class NextcloudUpload(object):
 
         share_token = match.group(1)
 
+        if self.gallery_index and self.gallery_index_url:
+            # Index page uploaded in the album, displayed by the configured server
+            return self.gallery_index_url.format(host=self.nhost, token=share_token)
         if self.gallery_app == "photos":
             # Nextcloud Photos app public view
             return f"{self.nhost}/apps/photos/public/{share_token}"
@@ -488,6 +1829,7 @@ class NextcloudUpload(object):
             # Direct share link (most reliable)
             return link
 
+    @timed('upload_photos')
     def upload_photos(self, local_source_file, album_name, activate):
         """Upload photo to Nextcloud
         :param local_source_file: Path to local file to upload
@@ -497,16 +1839,56 @@ class NextcloudUpload(object):
         :param activate: use to disable the upload
         :type activate: bool
         """
-        self.activate = activate
-
-        # Check if connected
-        if not self.is_connected:
-            LOGGER.error("Cannot upload: not connected to Nextcloud")
-            self.last_error = "Non connecte"
+        if not self._can_upload(activate):
             return False
 
-        # Check internet connection
-        if not self._is_internet():
+        LOGGER.info("In upload_photos Local (%s)", local_source_file)
+        LOGGER.info("In upload_photos Remote (%s)", album_name)
+
+        self._local.status = None
+        start = time.time()
+        try:
+            size = os.path.getsize(local_source_file)
+            chunk_size = self.chunk_size_mb * 1024 * 1024
+            chunked = chunk_size > 0 and size > chunk_size
+            if chunked:
+                # Big files are hashed while uploaded, unless already known
+                digests = known_file_digests(local_source_file)
+            else:
+                digests = shared_file_digests(local_source_file)
+            if digests and self._upload_duplicate(digests[0], album_name):
+                self.metrics.inc('deduplicated_files_total')
+                self.metrics.inc('deduplicated_bytes_total', size)
+                self.last_error = None
+                return True
+
+            if chunked:
+                digests = self._put_file_chunked(album_name, local_source_file, chunk_size,
+                                                 digests[1] if digests else None)
+            else:
+                self._put_file(album_name, local_source_file, digests[1])
+            self._upload_succeeded(album_name, digests[0], size, start)
+            return True
+        except Exception as e:
+            self._local.status = getattr(e, 'status_code', None)
+            self._upload_failed(e)
+            if self._local.status == 409:
+                # Missing folder (raw captures resumed after a restart), created for the next attempt
+                self._makedirs(os.path.dirname(album_name))
+            return False
+
+    def _can_upload(self, activate):
+        """Check that the server is reachable and the upload enabled"""
+        self.activate = activate
+
+        # Check if connected
+        if not self.is_connected:
+            LOGGER.error("Cannot upload: not connected to Nextcloud")
+            self.last_error = "Non connecte"
+            return False
+
+        # Check internet connection
+        if not self.monitor.online:
             LOGGER.error("Interrupt upload: no internet connection")
             self.last_error = "Pas de connexion internet"
             return False
@@ -515,61 +1897,2385 @@ class NextcloudUpload(object):
         if not self.activate:
             LOGGER.info("Upload disabled in configuration")
             return False
+        return self._circuit_allows_upload()
 
-        LOGGER.info("In upload_photos Local (%s)", local_source_file)
-        LOGGER.info("In upload_photos Remote (%s)", album_name)
+    def _circuit_allows_upload(self):
+        """Check that the server is not known to fail, to postpone the
+        upload without waiting for a timeout
+        """
+        if not self.http.breaker.ready():
+            LOGGER.info("Upload postponed: circuit open (%s)", self.http.breaker.kind)
+            self.last_error = CircuitBreaker.MESSAGES[self.http.breaker.kind]
+            return False
+        return True
 
-        try:
-            self.oc.put_file(album_name, local_source_file)
-            LOGGER.info("Photo uploaded to Nextcloud successfully!")
-            self.last_error = None
-            return True
-        except owncloud.HTTPResponseError as e:
-            if e.status_code == 507:
+    def _upload_succeeded(self, remote_file, digest, size, start):
+        """Record a successful upload in the journal and the metrics"""
+        LOGGER.info("Photo uploaded to Nextcloud successfully!")
+        self.last_error = None
+        if self.journal is not None:
+            self.journal.set_content(digest, remote_file, size)
+        self.metrics.inc('uploaded_bytes_total', size)
+        self.metrics.inc('uploaded_files_total')
+        self.metrics.observe('upload_throughput_bytes_per_second', size / max(time.time() - start, 1e-3),
+                             Metrics.THROUGHPUT_BUCKETS)
+
+    def _upload_failed(self, error):
+        """Report an upload error to the user and in the metrics"""
+        if isinstance(error, owncloud.HTTPResponseError):
+            self.metrics.inc('errors_total', stage='upload_photos', status=str(error.status_code))
+            if error.status_code == 507:
                 self.last_error = "Disque plein"
                 LOGGER.error("Upload failed: disk full on server (507)")
-            elif e.status_code == 403:
+            elif error.status_code == 403:
                 self.last_error = "Permission refusee"
                 LOGGER.error("Upload failed: permission denied (403)")
-            elif e.status_code == 404:
+            elif error.status_code == 404:
                 self.last_error = "Dossier introuvable"
                 LOGGER.error("Upload failed: destination folder not found (404)")
             else:
-                self.last_error = f"Erreur HTTP {e.status_code}"
-                LOGGER.error("Upload failed: HTTP error %s", e.status_code)
-            return False
-        except Exception as e:
+                self.last_error = f"Erreur HTTP {error.status_code}"
+                LOGGER.error("Upload failed: HTTP error %s", error.status_code)
+        elif isinstance(error, CircuitOpenError):
+            self.metrics.inc('errors_total', stage='upload_photos', status='circuit_open')
+            self.last_error = CircuitBreaker.MESSAGES[error.kind]
+            LOGGER.info("Upload postponed: circuit open (%s)", error.kind)
+        elif isinstance(error, requests.RequestException):
+            self.metrics.inc('errors_total', stage='upload_photos', status='network')
+            self.last_error = "Pas de connexion internet"
+            LOGGER.error("Upload failed: network error: %s", str(error))
+            self.monitor.report_failure()
+        else:
+            self.metrics.inc('errors_total', stage='upload_photos', status='other')
             self.last_error = "Erreur upload"
-            LOGGER.error("Error while uploading file to Nextcloud: %s", str(e))
+            LOGGER.error("Error while uploading file to Nextcloud: %s", str(error))
+
+    def _upload_duplicate(self, digest, remote_file):
+        """Avoid uploading a content already confirmed on the server: nothing
+        is done if it is already at the same place, else it is copied on
+        server side.
+        Returns: bool - True if no upload is needed anymore
+        """
+        if self.journal is None:
+            return False
+        known_file = self.journal.content(digest)
+        if known_file is None:
             return False
+        if known_file == remote_file:
+            LOGGER.info("Same content already uploaded, skipped (%s)", remote_file)
+            return True
+
+        response = self.http.request('COPY', self._dav_url(known_file),
+                                     headers={'Destination': self._dav_url(remote_file), 'Overwrite': 'T'})
+        if response.status_code in (201, 204):
+            LOGGER.info("Same content already uploaded, copied on server (%s -> %s)", known_file, remote_file)
+            return True
+        LOGGER.info("Server-side copy of %s returned HTTP %s, upload it", known_file, response.status_code)
+        return False
+
+    def _put_file(self, remote_file, local_source_file, sha1):
+        """Upload a file in a single request streamed from disk, the server
+        verifies its content with the given checksum
+        :raises: owncloud.HTTPResponseError if the server rejects the upload
+        """
+        headers = {'OC-Checksum': f"SHA1:{sha1}",
+                   'X-OC-MTime': str(int(os.path.getmtime(local_source_file)))}
+        with open(local_source_file, 'rb') as fp:
+            data = FileSlice(fp, 0, os.fstat(fp.fileno()).st_size, self.throttle)
+            response = self.http.request('PUT', self._dav_url(remote_file), data=data, headers=headers, timeout=60)
+        if response.status_code not in (200, 201, 204):
+            raise owncloud.HTTPResponseError(response)
+        return True
+
+    def _put_file_chunked(self, remote_file, local_source_file, chunk_size, sha1=None):
+        """Upload a file by chunks using the Nextcloud chunking v2 API.
+
+        The transfer is recorded in the journal: if it is interrupted, the
+        chunks already present on the server are skipped on next attempt.
+        If no checksum is given, it is computed while the chunks are read
+        and checked by the server when they are assembled.
+        :raises: owncloud.HTTPResponseError if the server rejects the upload
+        Returns: (str, str) - (blake2b, sha1) digests of the file
+        """
+        stat = os.stat(local_source_file)
+        destination = self._dav_url(remote_file)
+        headers = {'Destination': destination, 'OC-Total-Length': str(stat.st_size)}
+
+        uploaded = None
+        transfer = self.journal.transfer(local_source_file)
+        if transfer and transfer[1:] == (remote_file, stat.st_size, stat.st_mtime, chunk_size):
+            transfer_id = transfer[0]
+            upload_url = f"{self.nhost}/remote.php/dav/uploads/{quote(self.nuser)}/{transfer_id}"
+            chunks = self._propfind(upload_url, ['getcontentlength'], depth=1)
+            if chunks is not None:
+                uploaded = {os.path.basename(href.rstrip('/')): int(props.get('getcontentlength', -1))
+                            for href, props in chunks.items()}
+                LOGGER.info("Resume chunked upload of %s (%d chunk(s) on server)",
+                            local_source_file, len(uploaded) - 1)
+
+        if uploaded is None:
+            transfer_id = f"pibooth-{uuid.uuid4().hex}"
+            upload_url = f"{self.nhost}/remote.php/dav/uploads/{quote(self.nuser)}/{transfer_id}"
+            response = self.http.request('MKCOL', upload_url, headers=headers)
+            if response.status_code != 201:
+                raise owncloud.HTTPResponseError(response)
+            self.journal.set_transfer(local_source_file, transfer_id, remote_file,
+                                      stat.st_size, stat.st_mtime, chunk_size)
+            self.journal.flush()
+            uploaded = {}
+
+        digests = StreamDigests()
+        with open(local_source_file, 'rb') as fp:
+            for index in range(max(1, math.ceil(stat.st_size / chunk_size))):
+                offset = index * chunk_size
+                length = min(chunk_size, stat.st_size - offset)
+                name = f"{index + 1:05d}"
+                if uploaded.get(name) == length:
+                    # Already on server, only hashed (not throttled, nothing is sent)
+                    digests.feed(FileSlice(fp, offset, length, digests=digests))
+                    continue
+                self._put_chunk(f"{upload_url}/{name}", FileSlice(fp, offset, length, self.throttle, digests),
+                                headers)
+            digests.feed(FileSlice(fp, 0, stat.st_size, digests=digests))
 
+        blake2, checksum = digests.hexdigests()
+        if sha1 and sha1 != checksum:
+            raise IOError(f"{local_source_file} modified during upload")
+        # The checksum applies to the assembled file, not to each chunk
+        headers = dict(headers, **{'OC-Checksum': f"SHA1:{checksum}"})
+        response = self.http.request('MOVE', f"{upload_url}/.file", headers=headers, timeout=60)
+        if response.status_code not in (201, 204):
+            raise owncloud.HTTPResponseError(response)
+        self.journal.delete_transfer(local_source_file)
+        remember_file_digests(local_source_file, (blake2, checksum))
+        return blake2, checksum
 
+    def _put_chunk(self, url, data, headers):
+        """Upload one chunk, retry on network or server errors"""
+        for attempt in range(self.CHUNK_RETRIES):
+            try:
+                data.seek(0)
+                response = self.http.request('PUT', url, data=data, headers=headers, timeout=60)
+                if response.status_code in (201, 204):
+                    return
+                if response.status_code < 500 or attempt == self.CHUNK_RETRIES - 1:
+                    raise owncloud.HTTPResponseError(response)
+                LOGGER.warning("Chunk upload returned HTTP %s, retrying", response.status_code)
+            except requests.RequestException as e:
+                if attempt == self.CHUNK_RETRIES - 1:
+                    raise
+                LOGGER.warning("Chunk upload failed (%s), retrying", str(e))
+            self.metrics.inc('retries_total', stage='chunk')
+            time.sleep(backoff_delay(attempt))
+
+    @timed('synchronize_pics')
     def synchronize_pics(self, local_rep, rep_photos_nextcloud, album_name):
-        """Synchronize local directory with Nextcloud using nextcloudcmd
+        """Upload the files of the local directory which are new or modified
+        since the last synchronization.
+
+        The remote album is listed with a single PROPFIND request and compared
+        to the manifest kept in the upload journal, files are hashed only when
+        their size or modification time changed. When albums are rotated,
+        only the files modified during the period of the album are uploaded.
         """
         if not self.is_connected:
             LOGGER.warning("Synchronize: not connected to Nextcloud")
             return False
 
-        # Build nextcloudcmd command
-        USER_NC = self.nuser
-        PASS_NC = self.npassword
-        LOCAL_PATH_NC = local_rep
-        REMOTE_PATH_NC = self.nhost + "/remote.php/webdav/" + rep_photos_nextcloud + "/" + album_name
+        remote_dir = rep_photos_nextcloud + album_name + '/'
+        try:
+            remote = self._propfind(self._dav_url(remote_dir), ['getetag', 'getcontentlength'], depth=1)
+        except Exception as e:
+            LOGGER.warning("Synchronize: cannot list remote directory: %s", str(e))
+            remote = None
+        if remote is None:
+            self.last_error = "Erreur synchronisation"
+            return False
+        remote = {os.path.basename(href.rstrip('/')): props for href, props in remote.items()}
 
-        nextcloudcmd = (
-            f"nextcloudcmd -u {USER_NC} -p {PASS_NC} "
-            f"--path {rep_photos_nextcloud}{album_name} "
-            f"-s {LOCAL_PATH_NC} {REMOTE_PATH_NC}"
-        )
+        manifest = self.journal.manifest()
+        uploaded = 0
+        success = True
+        with os.scandir(local_rep) as entries:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                if self.album_rotation and self.album_for(stat.st_mtime) != album_name:
+                    continue
+                size, mtime, checksum, etag = manifest.get(entry.name, (None, None, None, None))
+                remote_props = remote.get(entry.name)
+
+                if size != stat.st_size or mtime != stat.st_mtime:
+                    new_checksum = file_checksum(entry.path)
+                    modified = new_checksum != checksum
+                    checksum = new_checksum
+                else:
+                    modified = False
 
-        LOGGER.info("Running nextcloudcmd synchronization...")
-        result = os.system(nextcloudcmd)
+                if remote_props is not None and not modified \
+                        and remote_props.get('getcontentlength') == str(stat.st_size):
+                    # Already on server, only refresh the manifest if needed
+                    if etag != remote_props.get('getetag') or size != stat.st_size or mtime != stat.st_mtime:
+                        self.journal.set_manifest(entry.name, stat.st_size, stat.st_mtime,
+                                                  checksum, remote_props.get('getetag'))
+                    continue
 
-        if result != 0:
-            LOGGER.warning("nextcloudcmd returned non-zero exit code: %s", result)
+                if remote_props is None:
+                    # Removed from the server, not skipped as an already uploaded content
+                    self.journal.delete_content(remote_dir + entry.name)
+                if self.upload_photos(entry.path, remote_dir + entry.name, self.activate_state):
+                    self.journal.set_manifest(entry.name, stat.st_size, stat.st_mtime, checksum, None)
+                    uploaded += 1
+                else:
+                    success = False
+
+        self.journal.flush()
+        if not success:
             self.last_error = "Erreur synchronisation"
             return False
 
-        LOGGER.info("Synchronization completed successfully")
+        LOGGER.info("Synchronization completed successfully (%d file(s) uploaded)", uploaded)
+        return True
+
+
+class ConnectivityMonitor(object):
+
+    """Background check of the Nextcloud server availability.
+
+    The server is probed every ``interval`` seconds while online. When it
+    becomes unreachable, it is probed again with a jittered exponential backoff and
+    ``on_online`` is called as soon as it answers again. While ``on_online``
+    returns False (login failed), it is called again at each probe, with the
+    same backoff.
+    """
+
+    MIN_DELAY = 2
+    MAX_DELAY = 120
+
+    def __init__(self, probe, on_online=None, interval=30):
+        """Initialize the monitor
+        :param probe: function returning True if the server is reachable
+        :type probe: callable
+        :param on_online: function called when the server is reachable again,
+                          returning False to be called again at next probe
+        :type on_online: callable
+        :param interval: delay in seconds between two probes while online
+        :type interval: int
+        """
+        self.probe = probe
+        self.on_online = on_online
+        self.interval = interval
+        self.online = False
+        self.rtt = None
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def check(self):
+        """Probe the server now and update the state
+        Returns: bool - True if the server is reachable
+        """
+        start = time.time()
+        online = self.probe()
+        if online:
+            self.rtt = time.time() - start
+        was_online, self.online = self.online, online
+        if online != was_online:
+            LOGGER.info("Nextcloud server %s", "online (RTT %.0f ms)" % (self.rtt * 1000) if online else "offline")
+        return online
+
+    def report_failure(self):
+        """Mark the server as unreachable after a network error, the
+        monitor probes it again immediately
+        """
+        self.online = False
+        self._wakeup.set()
+
+    def start(self):
+        """Start the background thread"""
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="NextcloudMonitor")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stop the background thread"""
+        if self._thread is not None:
+            self._stop.set()
+            self._wakeup.set()
+            self._thread.join(5)
+            self._thread = None
+
+    def _run(self):
+        """Monitor thread main loop"""
+        failures = 0
+        ready = self.on_online is None
+        while not self._stop.is_set():
+            was_online = self.online
+            if self.check():
+                if not was_online:
+                    failures = 0
+                if self.on_online and (not was_online or not ready):
+                    try:
+                        ready = self.on_online() is not False
+                    except Exception:
+                        ready = False
+                        LOGGER.error("Unexpected error on reconnection:\n%s", traceback.format_exc())
+                if ready:
+                    failures = 0
+                    timeout = self.interval
+                else:
+                    # Server reachable but not usable yet, tried again with backoff
+                    timeout = backoff_delay(failures, self.MIN_DELAY, self.MAX_DELAY)
+                    failures += 1
+            else:
+                timeout = backoff_delay(failures, self.MIN_DELAY, self.MAX_DELAY)
+                failures += 1
+            self._wakeup.wait(timeout)
+            self._wakeup.clear()
+
+
+class CircuitOpenError(IOError):
+
+    """Request not sent because the circuit breaker of the server is open."""
+
+    def __init__(self, kind):
+        super(CircuitOpenError, self).__init__(f"circuit open after {kind} failures")
+        self.kind = kind
+
+
+class CircuitBreaker(object):
+
+    """Stop sending requests to a failing Nextcloud server.
+
+    Each failure is classified: network error, overloaded server (429 and
+    5xx), refused credentials (401) or full quota (507). Other answers come
+    from a healthy server and reset the count. After ``threshold``
+    consecutive failures (a single one for credentials or quota, retrying
+    cannot fix them) the circuit opens and requests fail immediately with
+    :class:`CircuitOpenError`. After a jittered exponential delay one
+    request is let through as a probe (half-open): the circuit closes if it
+    succeeds and opens again for a longer delay otherwise.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    NETWORK = 'network'
+    OVERLOAD = 'overload'
+    AUTH = 'auth'
+    QUOTA = 'quota'
+
+    OVERLOAD_STATUS = (429, 500, 502, 503, 504)
+    IMMEDIATE = (AUTH, QUOTA)
+    MAX_DELAY = 300
+    PROBE_TIMEOUT = 120
+
+    MESSAGES = {NETWORK: "Pas de connexion internet",
+                OVERLOAD: "Serveur surcharge",
+                AUTH: "Identifiants refuses",
+                QUOTA: "Disque plein"}
+
+    def __init__(self, threshold=5, reset_delay=10):
+        """Initialize the breaker
+        :param threshold: number of consecutive failures opening the circuit
+        :type threshold: int
+        :param reset_delay: delay in seconds before the first probe, doubled
+                            each time the probe fails
+        :type reset_delay: float
+        """
+        self.threshold = max(1, threshold)
+        self.reset_delay = reset_delay
+        self.state = self.CLOSED
+        self.kind = None
+        self.failures = 0
+        self.opened = 0
+        self.open_until = 0
+        self._probe_start = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def classify(cls, error=None, status=None):
+        """Return the kind of failure of a request
+        :param error: exception raised by the request
+        :type error: Exception
+        :param status: HTTP status of the answer
+        :type status: int
+        Returns: str - kind of failure, None if the server is healthy
+        """
+        if isinstance(error, owncloud.HTTPResponseError):
+            status = error.status_code
+        elif isinstance(error, requests.RequestException):
+            return cls.NETWORK
+        if status == 507:
+            return cls.QUOTA
+        if status == 401:
+            return cls.AUTH
+        if status in cls.OVERLOAD_STATUS:
+            return cls.OVERLOAD
+        return None
+
+    def allow(self):
+        """Check if a request can be sent, the first call after the open
+        delay is the half-open probe
+        Returns: bool - False if the request must not be sent
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state == self.OPEN and now >= self.open_until \
+                    or self.state == self.HALF_OPEN and now - self._probe_start > self.PROBE_TIMEOUT:
+                LOGGER.info("Circuit half-open, probe the server")
+                self.state = self.HALF_OPEN
+                self._probe_start = now
+                return True
+            return False
+
+    def ready(self):
+        """Check without side effect if a request would be let through
+        Returns: bool - True if closed or if the open delay is elapsed
+        """
+        return self.state == self.CLOSED or self.state == self.OPEN and time.monotonic() >= self.open_until
+
+    def success(self):
+        """Record a request answered by a healthy server"""
+        with self._lock:
+            if self.state != self.CLOSED:
+                LOGGER.info("Circuit closed, server available again")
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened = 0
+
+    def failure(self, kind):
+        """Record a failed request
+        :param kind: kind of failure returned by :meth:`classify`
+        :type kind: str
+        """
+        with self._lock:
+            self.kind = kind
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.state == self.CLOSED \
+                    and self.failures >= (1 if kind in self.IMMEDIATE else self.threshold):
+                delay = backoff_delay(self.opened, self.reset_delay, self.MAX_DELAY)
+                self.opened += 1
+                self.state = self.OPEN
+                self.open_until = time.monotonic() + delay
+                LOGGER.warning("Circuit open after %d %s failure(s), next try in %.0fs", self.failures, kind, delay)
+
+    def record(self, error=None, status=None):
+        """Record the result of a request, see :meth:`classify`"""
+        kind = self.classify(error, status)
+        if kind:
+            self.failure(kind)
+        else:
+            self.success()
+
+    def network_restored(self):
+        """Close the circuit opened by network failures once the server
+        answers the connectivity probe again
+        """
+        if self.state != self.CLOSED and self.kind == self.NETWORK:
+            self.success()
+
+    def check(self):
+        """Raise :class:`CircuitOpenError` if a request cannot be sent"""
+        if not self.allow():
+            raise CircuitOpenError(self.kind)
+
+
+class GuardedAdapter(object):
+
+    """Transport adapter checking the circuit breaker of a :class:`HttpPool`
+    before each request and recording its result, the requests made
+    through pyocclient are guarded as well. The connections are kept by the
+    wrapped ``requests`` adapter.
+    """
+
+    def __init__(self, pool, **kwargs):
+        self.pool = pool
+        self.adapter = requests.adapters.HTTPAdapter(**kwargs)
+
+    def send(self, request, **kwargs):
+        if not getattr(self.pool._local, 'guarded', True):
+            return self.adapter.send(request, **kwargs)
+        breaker = self.pool.breaker
+        breaker.check()
+        try:
+            response = self.adapter.send(request, **kwargs)
+        except requests.RequestException:
+            breaker.failure(CircuitBreaker.NETWORK)
+            raise
+        breaker.record(status=response.status_code)
+        return response
+
+    def close(self):
+        self.adapter.close()
+
+
+class QuotaTracker(object):
+
+    """Free space on the server, known locally between two requests.
+
+    The free space is requested once, then decreased by the size of each
+    uploaded file. It is requested again in background when older than
+    ``ttl`` seconds or when close to the minimum required space, so that
+    :meth:`check` never waits for the network.
+    """
+
+    MIN_REFRESH_INTERVAL = 10
+    SAFETY_FACTOR = 2
+
+    def __init__(self, fetch, ttl=300):
+        """Initialize the tracker
+        :param fetch: function returning the free bytes on the server
+                      (negative if unlimited, None if unknown)
+        :type fetch: callable
+        :param ttl: maximum age in seconds of the known free space
+        :type ttl: int
+        """
+        self.fetch = fetch
+        self.ttl = ttl
+        self.free_bytes = None
+        self.updated = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def refresh(self):
+        """Request the free space on the server (blocking)"""
+        free_bytes = self.fetch()
+        with self._lock:
+            self.free_bytes = free_bytes
+            self.updated = time.time()
+            self._refreshing = False
+        if free_bytes is not None and free_bytes >= 0:
+            LOGGER.info("Disk quota: %.0f MB free", free_bytes / (1024 * 1024))
+
+    def update(self, free_bytes):
+        """Set the free space returned by another request to the server"""
+        with self._lock:
+            self.free_bytes = free_bytes
+            self.updated = time.time()
+
+    def _refresh_later(self, min_bytes):
+        """Start a background refresh if the known value is too old or too
+        close to the minimum space
+        """
+        with self._lock:
+            age = time.time() - self.updated
+            if self._refreshing or age < self.MIN_REFRESH_INTERVAL:
+                return
+            near_limit = self.free_bytes is not None and 0 <= self.free_bytes < min_bytes * self.SAFETY_FACTOR
+            if age < self.ttl and not near_limit:
+                return
+            self._refreshing = True
+        thread = threading.Thread(target=self.refresh, name="NextcloudQuota")
+        thread.daemon = True
+        thread.start()
+
+    def consume(self, nbytes):
+        """Decrease the known free space after an upload"""
+        with self._lock:
+            if self.free_bytes is not None and self.free_bytes >= 0:
+                self.free_bytes = max(0, self.free_bytes - nbytes)
+
+    def check(self, min_space_mb):
+        """Compare the known free space to the minimum required
+        Returns: (bool, str) - (is_ok, message)
+        """
+        self._refresh_later(min_space_mb * 1024 * 1024)
+        free_bytes = self.free_bytes
+
+        if free_bytes is None:
+            # Don't block if we can't check quota
+            return True, "Quota non verifie"
+        if free_bytes < 0:
+            return True, "Quota illimite"
+
+        free_mb = free_bytes / (1024 * 1024)
+        if free_mb < min_space_mb:
+            return False, f"Espace insuffisant: {free_mb:.0f}MB libre (min: {min_space_mb}MB)"
+        return True, f"{free_mb:.0f}MB libre"
+
+
+class AdaptiveConcurrency(object):
+
+    """Number of parallel uploads tuned from the observed throughput.
+
+    The limit is increased while the throughput measured over a window of
+    uploads improves, decreased when it drops, and halved when the server
+    reports an overload.
+    """
+
+    def __init__(self, initial=2, minimum=1, maximum=8):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = max(minimum, min(initial, maximum))
+        self._bytes = 0
+        self._count = 0
+        self._start = time.time()
+        self._last_throughput = 0
+
+    def success(self, nbytes, elapsed):
+        """Record a finished upload"""
+        self._bytes += nbytes
+        self._count += 1
+        if self._count < self.limit:
+            return
+        throughput = self._bytes / max(time.time() - self._start, 1e-3)
+        if throughput > self._last_throughput * 1.05:
+            self.limit = min(self.limit + 1, self.maximum)
+        elif throughput < self._last_throughput * 0.8:
+            self.limit = max(self.limit - 1, self.minimum)
+        self._last_throughput = throughput
+        self._bytes = self._count = 0
+        self._start = time.time()
+
+    def overloaded(self):
+        """Record a HTTP 429/503 response from the server"""
+        self.limit = max(self.minimum, self.limit // 2)
+        self._bytes = self._count = 0
+        self._start = time.time()
+
+
+class BatchProgress(object):
+
+    """Aggregated throughput and remaining time of a batch upload."""
+
+    def __init__(self, total_bytes, count):
+        self.total_bytes = total_bytes
+        self.count = count
+        self.sent_bytes = 0
+        self.done = 0
+        self.failed = 0
+        self.start = time.time()
+
+    def update(self, nbytes, failed=False):
+        """Record a finished upload"""
+        self.done += 1
+        if failed:
+            self.failed += 1
+            self.total_bytes -= nbytes
+        else:
+            self.sent_bytes += nbytes
+
+    @property
+    def throughput(self):
+        """Average throughput in bytes per second"""
+        return self.sent_bytes / max(time.time() - self.start, 1e-3)
+
+    @property
+    def eta(self):
+        """Estimated remaining time in seconds"""
+        throughput = self.throughput
+        if not throughput:
+            return float('inf') if self.done < self.count else 0
+        return max(0, self.total_bytes - self.sent_bytes) / throughput
+
+
+class Metrics(object):
+
+    """Thread-safe counters, gauges and histograms of the plugin activity.
+
+    Values are identified by a name and optional labels, they can be
+    exported in the Prometheus text format or as a dictionary.
+    """
+
+    PREFIX = 'pibooth_nextcloud'
+    DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+    THROUGHPUT_BUCKETS = (8e3, 32e3, 128e3, 512e3, 2e6, 8e6, 32e6)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        """Increment a counter"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set the value of a gauge"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.gauges[key] = value
+
+    def observe(self, name, value, buckets=DURATION_BUCKETS, **labels):
+        """Add a value to a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {'buckets': buckets, 'counts': [0] * len(buckets),
+                                                    'sum': 0, 'count': 0}
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['counts'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        """Context manager recording the duration of a stage"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe('duration_seconds', time.time() - start, stage=stage)
+
+    @staticmethod
+    def _labels(labels, **extra):
+        """Format labels in the Prometheus syntax"""
+        items = list(labels) + list(extra.items())
+        if not items:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(key, value) for key, value in items) + '}'
+
+    def to_prometheus(self):
+        """Return the metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{self.PREFIX}_{name}{self._labels(labels)} {value}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f"{self.PREFIX}_{name}{self._labels(labels)} {value}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                for bound, count in zip(histogram['buckets'], histogram['counts']):
+                    lines.append(f"{self.PREFIX}_{name}_bucket{self._labels(labels, le=bound)} {count}")
+                lines.append(f"{self.PREFIX}_{name}_bucket{self._labels(labels, le='+Inf')} {histogram['count']}")
+                lines.append(f"{self.PREFIX}_{name}_sum{self._labels(labels)} {histogram['sum']}")
+                lines.append(f"{self.PREFIX}_{name}_count{self._labels(labels)} {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        """Return the metrics as a JSON serializable dictionary"""
+        def name(key):
+            return key[0] + self._labels(key[1])
+        with self._lock:
+            return {
+                'host': socket.gethostname(),
+                'time': time.time(),
+                'counters': {name(key): value for key, value in self.counters.items()},
+                'gauges': {name(key): value for key, value in self.gauges.items()},
+                'histograms': {name(key): {'sum': histogram['sum'], 'count': histogram['count'],
+                                           'buckets': dict(zip(map(str, histogram['buckets']),
+                                                               histogram['counts']))}
+                               for key, histogram in self.histograms.items()},
+            }
+
+
+class MetricsExporter(object):
+
+    """Expose the metrics on a local HTTP endpoint (``/metrics`` in the
+    Prometheus format, ``/metrics.json``) and save them periodically in a
+    JSON file.
+    """
+
+    def __init__(self, metrics, port=0, filename='', interval=60):
+        """Initialize the exporter
+        :param metrics: metrics to export
+        :type metrics: Metrics
+        :param port: port of the HTTP server, 0 to disable it
+        :type port: int
+        :param filename: path of the JSON file, empty to disable it
+        :type filename: str
+        :param interval: delay in seconds between two saves of the file
+        :type interval: int
+        """
+        self.metrics = metrics
+        self.port = port
+        self.filename = filename
+        self.interval = max(1, interval)
+        self._server = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start the HTTP server and the file dump thread"""
+        if self.port and self._server is None:
+            metrics = self.metrics
+
+            class Handler(http.server.BaseHTTPRequestHandler):
+
+                def do_GET(self):
+                    if self.path == '/metrics':
+                        body, content_type = metrics.to_prometheus(), 'text/plain; version=0.0.4'
+                    elif self.path == '/metrics.json':
+                        body, content_type = json.dumps(metrics.to_dict()), 'application/json'
+                    else:
+                        self.send_error(404)
+                        return
+                    body = body.encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', content_type)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            try:
+                self._server = http.server.ThreadingHTTPServer(('', self.port), Handler)
+            except OSError as e:
+                LOGGER.warning("Could not start metrics server on port %s: %s", self.port, str(e))
+            else:
+                thread = threading.Thread(target=self._server.serve_forever, name="NextcloudMetrics")
+                thread.daemon = True
+                thread.start()
+                LOGGER.info("Metrics available on http://localhost:%s/metrics", self.port)
+
+        if self.filename and self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="NextcloudMetricsDump")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stop the HTTP server and save the metrics a last time"""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join(5)
+            self._thread = None
+            self.dump()
+
+    def dump(self):
+        """Save the metrics in the JSON file"""
+        try:
+            with open(self.filename + '.tmp', 'w', encoding='utf-8') as fp:
+                json.dump(self.metrics.to_dict(), fp, indent=2)
+            os.replace(self.filename + '.tmp', self.filename)
+        except OSError as e:
+            LOGGER.warning("Could not save metrics file: %s", str(e))
+
+    def _run(self):
+        """Dump thread main loop"""
+        while not self._stop.wait(self.interval):
+            self.dump()
+
+
+class HttpPool(object):
+
+    """Keep-alive HTTP connections shared by all the requests to the server.
+
+    Each thread gets its own ``requests.Session`` (sessions are not thread
+    safe) but all of them share the same connection pool and cookie jar, so
+    TCP/TLS connections and the Nextcloud session cookie are reused. All
+    the requests go through the :class:`CircuitBreaker` of the pool.
+    """
+
+    def __init__(self, pool_size=4, breaker=None):
+        """Initialize the pool
+        :param pool_size: maximum number of connections kept open per host
+        :type pool_size: int
+        :param breaker: circuit breaker guarding the requests
+        :type breaker: :class:`CircuitBreaker`
+        """
+        self.auth = None
+        self.pool_size = pool_size
+        self.breaker = breaker or CircuitBreaker()
+        self.adapter = None
+        self.cookies = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def session(self):
+        """Return the session of the calling thread, the connection pool is
+        created on first use
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            with self._lock:
+                if self.adapter is None:
+                    self.adapter = GuardedAdapter(self, pool_connections=2, pool_maxsize=max(1, self.pool_size))
+                    self.cookies = requests.cookies.RequestsCookieJar()
+            session = requests.Session()
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+            session.cookies = self.cookies
+            self._local.session = session
+        return session
+
+    def request(self, method, url, guarded=True, **kwargs):
+        """Send a request using a pooled connection, see ``requests.request``
+        :param guarded: False to bypass the circuit breaker (connectivity probe)
+        :type guarded: bool
+        """
+        kwargs.setdefault('auth', self.auth)
+        kwargs.setdefault('timeout', 10)
+        self._local.guarded = guarded
+        try:
+            return self.session().request(method, url, **kwargs)
+        finally:
+            self._local.guarded = True
+
+    def stats(self):
+        """Return the number of connections opened and reused since start
+        Returns: (int, int) - (opened, reused)
+        """
+        opened = requests_count = 0
+        if self.adapter is None:
+            return opened, requests_count
+        pools = self.adapter.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                requests_count += pool.num_requests
+        return opened, max(0, requests_count - opened)
+
+
+def pooled_client(url, http_pool, **kwargs):
+    """Return an owncloud client using the connections of a :class:`HttpPool`
+    :param url: URL of the server
+    :type url: str
+    :param http_pool: connections to use
+    :type http_pool: :class:`HttpPool`
+    Returns: owncloud.Client - client not logged in
+    """
+    return _pooled_client_class()(url, http_pool, **kwargs)
+
+
+@functools.lru_cache(maxsize=None)
+def _pooled_client_class():
+    """Define the client class on first use, pyocclient is not imported
+    before a connection to the server is needed
+    """
+
+    class PooledClient(owncloud.Client):
+
+        """Owncloud client using the connections of a :class:`HttpPool`."""
+
+        def __init__(self, url, http_pool, **kwargs):
+            super(PooledClient, self).__init__(url, **kwargs)
+            self._http = http_pool
+
+        def login(self, user_id, password):
+            """Authenticate to Nextcloud using a pooled session
+            :raises: HTTPResponseError in case an HTTP error status was returned
+            """
+            self._session = self._http.session()
+            self._session.verify = self._verify_certs
+            self._session.auth = (user_id, password)
+
+            try:
+                self._update_capabilities()
+            except owncloud.HTTPResponseError:
+                self._session = None
+                raise
+
+    return PooledClient
+
+
+class UploadWorkerPool(object):
+
+    """Bounded queue of pictures drained by background upload threads.
+
+    Pictures are uploaded by priority class: latest captures first (the
+    most recent one before the others), then the backlog, then originals.
+    """
+
+    LATEST = 0
+    BACKLOG = 1
+    ORIGINAL = 2
+
+    # Priority classes whose files queued together are uploaded as a session
+    SESSION_PRIORITIES = (LATEST, ORIGINAL)
+
+    def __init__(self, nextcloud, workers=2, max_size=200):
+        """Initialize the pool
+        :param nextcloud: instance performing the uploads
+        :type nextcloud: NextcloudUpload
+        :param workers: number of upload threads
+        :type workers: int
+        :param max_size: maximum number of pictures waiting in the queue
+        :type max_size: int
+        """
+        self.nextcloud = nextcloud
+        self.nb_workers = max(1, workers)
+        self.queue = queue.PriorityQueue(max(1, max_size))
+        self.threads = []
+        self._counter = itertools.count()
+
+    def start(self):
+        """Start the upload threads"""
+        for index in range(self.nb_workers):
+            thread = threading.Thread(target=self._run, name="NextcloudUpload-{}".format(index))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        LOGGER.info("Started %d Nextcloud upload worker(s)", self.nb_workers)
+
+    def put(self, local_source_file, remote_file, priority=BACKLOG):
+        """Add a picture to the queue without blocking
+        Returns: bool - False if the queue is full
+        """
+        if not self._put((local_source_file, remote_file), priority):
+            LOGGER.warning("Upload queue full, picture not queued (%s)", local_source_file)
+            return False
+        return True
+
+    def put_session(self, session):
+        """Add the files of a session to the queue without blocking, they
+        are uploaded by the same worker
+        Returns: bool - False if the queue is full
+        """
+        if not self._put(session, session.priority):
+            LOGGER.warning("Upload queue full, session of %d file(s) not queued", len(session))
+            return False
+        return True
+
+    def _put(self, job, priority):
+        order = next(self._counter)
+        if priority == self.LATEST:
+            order = -order  # Most recent capture first
+        try:
+            self.queue.put_nowait((priority, order, job))
+            self.nextcloud.metrics.set('queue_depth', self.queue.qsize())
+            return True
+        except queue.Full:
+            return False
+
+    def latest_waiting(self):
+        """Return True if a job of the ``LATEST`` class is waiting in the queue"""
+        with self.queue.mutex:
+            return bool(self.queue.queue) and self.queue.queue[0][0] == self.LATEST
+
+    def free_slots(self):
+        """Return the number of pictures that can be queued without blocking"""
+        return max(0, self.queue.maxsize - self.queue.qsize())
+
+    def stop(self, timeout=5):
+        """Ask the upload threads to terminate and wait for them"""
+        for _ in self.threads:
+            try:
+                self.queue.put((-1, next(self._counter), None), timeout=timeout)
+            except queue.Full:
+                break
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def _run(self):
+        """Upload thread main loop"""
+        while True:
+            _, _, job = self.queue.get()
+            self.nextcloud.metrics.set('queue_depth', self.queue.qsize())
+            try:
+                if job is None:
+                    break
+                if isinstance(job, UploadSession):
+                    self.nextcloud.process_session(job)
+                else:
+                    self.nextcloud.process_upload(*job)
+            except Exception:
+                LOGGER.error("Unexpected error in upload worker:\n%s", traceback.format_exc())
+            finally:
+                self.queue.task_done()
+
+
+class UploadSession(object):
+
+    """Files of the same priority class queued within a short window,
+    uploaded together by one worker in the order they were queued.
+    """
+
+    def __init__(self, priority):
+        self.priority = priority
+        self._files = []
+
+    def __len__(self):
+        return len(self._files)
+
+    def add(self, local_source_file, remote_file):
+        """Add a file to the session"""
+        self._files.append((local_source_file, remote_file))
+
+    def files(self):
+        """Return the files in upload order
+        Returns: list - (local_source_file, remote_file)
+        """
+        return list(self._files)
+
+
+class SessionBatcher(object):
+
+    """Group the files queued for upload within ``window`` seconds in one
+    :class:`UploadSession` per priority class.
+
+    A capture produces several files in a burst (lightweight copy, original,
+    raw captures): uploaded as sessions, they share the connection and the
+    folder creation of a single worker instead of waking all of them. The
+    originals and raw captures stay in their own session, queued after the
+    backlog.
+    """
+
+    MAX_FILES = 32
+
+    def __init__(self, nextcloud, window=1.0):
+        """Initialize the batcher
+        :param nextcloud: instance performing the uploads
+        :type nextcloud: NextcloudUpload
+        :param window: delay in seconds after the first file of a session
+                       before it is queued
+        :type window: float
+        """
+        self.nextcloud = nextcloud
+        self.window = window
+        self.sessions = {}  # priority: (session, timer)
+        self._lock = threading.Lock()
+
+    def add(self, local_source_file, remote_file, priority):
+        """Add a file to the current session of its priority class, a new
+        one is opened if needed
+        """
+        with self._lock:
+            if priority not in self.sessions:
+                timer = threading.Timer(self.window, self.flush, (priority,))
+                timer.daemon = True
+                timer.start()
+                self.sessions[priority] = (UploadSession(priority), timer)
+            session = self.sessions[priority][0]
+            session.add(local_source_file, remote_file)
+            full = len(session) >= self.MAX_FILES
+        if full:
+            self.flush(priority)
+
+    def flush(self, priority=None):
+        """Queue the current session of a priority class for upload
+        :param priority: priority class, all the sessions if None
+        :type priority: int
+        """
+        with self._lock:
+            if priority is None:
+                sessions = list(self.sessions.values())
+                self.sessions = {}
+            else:
+                sessions = [self.sessions.pop(priority)] if priority in self.sessions else []
+        for session, timer in sorted(sessions, key=lambda item: item[0].priority):
+            timer.cancel()
+            self.nextcloud.enqueue_session(session)
+
+
+class AsyncHttpClient(object):
+
+    """Minimal HTTP/1.1 client on asyncio streams, used by the asyncio
+    upload engine.
+
+    Connections are kept alive and reused, request bodies are streamed
+    from disk by blocks. Network errors are raised as
+    ``requests.ConnectionError`` to be handled like the thread-based path.
+    """
+
+    BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, max_connections=16, timeout=60):
+        """Initialize the client, it must be used from a single event loop
+        :param max_connections: maximum number of simultaneous requests
+        :type max_connections: int
+        :param timeout: maximum duration in seconds of a request
+        :type timeout: int
+        """
+        self.max_connections = max(1, max_connections)
+        self.timeout = timeout
+        self.cookies = {}
+        self.opened = 0
+        self.reused = 0
+        self._idle = {}
+        self._slots = None
+
+    async def request(self, method, url, headers=None, auth=None, body=None, length=0, throttle=None):
+        """Send a request and read the whole response
+        :param body: opened binary file, ``length`` bytes are sent from its
+                     current position
+        :type body: file
+        :param throttle: bandwidth limiter of the request body
+        :type throttle: TokenBucket
+        Returns: (int, dict, bytes) - status, headers and content
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_connections)
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        target = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        head = [f"{method} {target} HTTP/1.1", f"Host: {parts.netloc}", f"Content-Length: {length}"]
+        if auth:
+            token = base64.b64encode('{}:{}'.format(*auth).encode('utf-8')).decode('ascii')
+            head.append(f"Authorization: Basic {token}")
+        if self.cookies:
+            head.append("Cookie: " + '; '.join('='.join(item) for item in self.cookies.items()))
+        head.extend(f"{name}: {value}" for name, value in (headers or {}).items())
+        head = ('\r\n'.join(head) + '\r\n\r\n').encode('latin-1')
+        position = body.tell() if body is not None else 0
+
+        async with self._slots:
+            for attempt in range(2):
+                connection, reused = await self._connect(key)
+                try:
+                    if body is not None:
+                        body.seek(position)
+                    response = await asyncio.wait_for(
+                        self._exchange(connection, head, body, length, throttle, method), self.timeout)
+                except (OSError, EOFError, ValueError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                    connection[1].close()
+                    if reused and attempt == 0:
+                        continue  # Connection closed by the server while idle
+                    raise requests.ConnectionError(f"{method} {url}: {e!r}")
+                status, response_headers, content, keep_alive = response
+                if keep_alive:
+                    self._idle.setdefault(key, []).append(connection)
+                else:
+                    connection[1].close()
+                return status, response_headers, content
+
+    async def _connect(self, key):
+        """Return an idle connection to the given server or open a new one"""
+        idle = self._idle.get(key)
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof():
+                self.reused += 1
+                return (reader, writer), True
+            writer.close()
+        scheme, host, port = key
+        context = ssl.create_default_context() if scheme == 'https' else None
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port, ssl=context), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise requests.ConnectionError(f"{host}:{port}: {e!r}")
+        self.opened += 1
+        return (reader, writer), False
+
+    async def _exchange(self, connection, head, body, length, throttle, method):
+        """Send the request and read the response on a connection"""
+        reader, writer = connection
+        writer.write(head)
+        remaining = length
+        while remaining > 0:
+            block = body.read(min(self.BLOCK_SIZE, remaining))
+            if not block:
+                raise EOFError("file truncated during upload")
+            if throttle is not None:
+                delay = throttle.reserve(len(block))
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            writer.write(block)
+            await writer.drain()
+            remaining -= len(block)
+        await writer.drain()
+
+        status_line = await reader.readline()
+        if not status_line:
+            raise EOFError("connection closed by server")
+        version, status = status_line.decode('latin-1').split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').rstrip('\r\n')
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            name, value = name.strip().lower(), value.strip()
+            if name == 'set-cookie':
+                cookie_name, _, cookie_value = value.split(';', 1)[0].partition('=')
+                self.cookies[cookie_name.strip()] = cookie_value.strip()
+            headers[name] = value
+
+        status = int(status)
+        keep_alive = headers.get('connection', '').lower() != 'close' and version != 'HTTP/1.0'
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            content = b''
+        elif headers.get('transfer-encoding', '').lower() == 'chunked':
+            blocks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b''):
+                        pass  # Trailers
+                    break
+                blocks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            content = b''.join(blocks)
+        elif 'content-length' in headers:
+            content = await reader.readexactly(int(headers['content-length']))
+        else:
+            content = await reader.read()
+            keep_alive = False
+        return status, headers, content, keep_alive
+
+    def stats(self):
+        """Return the number of connections opened and reused
+        Returns: (int, int) - (opened, reused)
+        """
+        return self.opened, self.reused
+
+    def close(self):
+        """Close the idle connections"""
+        for connections in self._idle.values():
+            for _, writer in connections:
+                writer.close()
+        self._idle = {}
+
+
+class AsyncUploadEngine(UploadWorkerPool):
+
+    """Upload queue drained by an asyncio event loop in a single thread.
+
+    Up to ``concurrency`` uploads are in flight at once with a fixed memory
+    footprint, instead of a thread per upload. Hashing, server-side copies
+    of duplicates, chunked uploads and directory synchronization are
+    delegated to one helper thread running the thread-based code.
+    """
+
+    # New captures are uploaded concurrently, only originals and raw
+    # captures are grouped in sessions run by the helper thread
+    SESSION_PRIORITIES = (UploadWorkerPool.ORIGINAL,)
+
+    def __init__(self, nextcloud, concurrency=16, max_size=200):
+        """Initialize the engine
+        :param nextcloud: instance performing the uploads
+        :type nextcloud: NextcloudUpload
+        :param concurrency: maximum number of uploads in flight
+        :type concurrency: int
+        :param max_size: maximum number of pictures waiting in the queue
+        :type max_size: int
+        """
+        super(AsyncUploadEngine, self).__init__(nextcloud, 1, max_size)
+        self.concurrency = max(1, concurrency)
+        self.client = AsyncHttpClient(self.concurrency)
+        self.loop = None
+        self.executor = None
+        self._wakeup = None
+
+    def start(self):
+        """Start the event loop thread"""
+        self.loop = asyncio.new_event_loop()
+        self.executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="NextcloudUploadHelper")
+        thread = threading.Thread(target=self.loop.run_until_complete, args=(self._dispatch(),),
+                                  name="NextcloudUpload-asyncio")
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+        LOGGER.info("Started Nextcloud asyncio upload engine (%d uploads in flight)", self.concurrency)
+
+    def _put(self, job, priority):
+        if not super(AsyncUploadEngine, self)._put(job, priority):
+            return False
+        self._wake()
+        return True
+
+    def stop(self, timeout=5):
+        """Ask the event loop to terminate and wait for it"""
+        if self.threads:
+            try:
+                self.queue.put((-1, next(self._counter), None), timeout=timeout)
+                self._wake()
+            except queue.Full:
+                pass
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def _wake(self):
+        """Wake up the dispatcher, called from any thread"""
+        if self._wakeup is not None and not self.loop.is_closed():
+            try:
+                self.loop.call_soon_threadsafe(self._wakeup.set)
+            except RuntimeError:
+                pass  # Loop closed meanwhile
+
+    async def _dispatch(self):
+        """Start an upload task for each queued picture, at most
+        ``concurrency`` at once
+        """
+        self._wakeup = asyncio.Event()
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        while True:
+            await slots.acquire()
+            while True:
+                try:
+                    _, _, job = self.queue.get_nowait()
+                    break
+                except queue.Empty:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+            self.nextcloud.metrics.set('queue_depth', self.queue.qsize())
+            if job is None:
+                break
+            if isinstance(job, UploadSession):
+                task = asyncio.ensure_future(self._process_session(job))
+            else:
+                task = asyncio.ensure_future(self._process(*job))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            task.add_done_callback(lambda _: slots.release())
+        if tasks:
+            await asyncio.wait(tasks)
+        self.client.close()
+
+    async def _process(self, local_source_file, remote_file):
+        """Upload a queued picture and record the result in the journal"""
+        nextcloud = self.nextcloud
+        try:
+            nextcloud.journal.set_state(local_source_file, UploadJournal.IN_FLIGHT)
+            uploaded = await self._upload(local_source_file, remote_file)
+            nextcloud._upload_finished(local_source_file, remote_file, uploaded)
+        except Exception:
+            LOGGER.error("Unexpected error in asyncio upload engine:\n%s", traceback.format_exc())
+        finally:
+            self.queue.task_done()
+
+    async def _process_session(self, session):
+        """Upload the files of a session one after the other in the helper
+        thread, on a single connection
+        """
+        try:
+            await asyncio.get_event_loop().run_in_executor(self.executor, self.nextcloud.process_session, session)
+        except Exception:
+            LOGGER.error("Unexpected error in asyncio upload engine:\n%s", traceback.format_exc())
+        finally:
+            self.queue.task_done()
+
+    async def _upload(self, local_source_file, remote_file):
+        """Check quota then upload the picture in a single streamed request"""
+        nextcloud = self.nextcloud
+        loop = asyncio.get_event_loop()
+        size = os.path.getsize(local_source_file)
+        chunk_size = nextcloud.chunk_size_mb * 1024 * 1024
+        if nextcloud.useSynchronize == 'True' or nextcloud.useSynchronize == True \
+                or (chunk_size > 0 and size > chunk_size):
+            return await loop.run_in_executor(self.executor, nextcloud._upload_queued,
+                                              local_source_file, remote_file)
+
+        if not nextcloud._quota_allows_upload() or not nextcloud._can_upload(nextcloud.activate_state):
+            return False
+
+        LOGGER.info("Upload Photo (%s)...", local_source_file)
+        start = time.time()
+        with nextcloud.metrics.timer('upload_photos'):
+            try:
+                digest, sha1, duplicate = await loop.run_in_executor(
+                    self.executor, self._prepare, local_source_file, remote_file)
+                if duplicate:
+                    nextcloud.metrics.inc('deduplicated_files_total')
+                    nextcloud.metrics.inc('deduplicated_bytes_total', size)
+                    nextcloud.last_error = None
+                    return True
+
+                headers = {'OC-Checksum': f"SHA1:{sha1}",
+                           'X-OC-MTime': str(int(os.path.getmtime(local_source_file)))}
+                nextcloud.http.breaker.check()
+                try:
+                    with open(local_source_file, 'rb') as fp:
+                        status, _, _ = await self.client.request(
+                            'PUT', nextcloud._dav_url(remote_file), headers, (nextcloud.nuser, nextcloud.npassword),
+                            fp, size, nextcloud.throttle)
+                except requests.RequestException:
+                    nextcloud.http.breaker.failure(CircuitBreaker.NETWORK)
+                    raise
+                nextcloud.http.breaker.record(status=status)
+                if status not in (200, 201, 204):
+                    raise owncloud.HTTPResponseError(status)
+                nextcloud._upload_succeeded(remote_file, digest, size, start)
+            except Exception as e:
+                nextcloud._upload_failed(e)
+                if getattr(e, 'status_code', None) == 409:
+                    # Missing folder (raw captures resumed after a restart), created for the next attempt
+                    await loop.run_in_executor(self.executor, nextcloud._makedirs, os.path.dirname(remote_file))
+                return False
+        nextcloud.quota.consume(size)
         return True
+
+    def _prepare(self, local_source_file, remote_file):
+        """Compute the digests of a picture and copy it on server side if
+        the same content was already uploaded. Run in the helper thread.
+        Returns: (str, str, bool) - (blake2b, sha1, duplicate)
+        """
+        digest, sha1 = shared_file_digests(local_source_file)
+        return digest, sha1, self.nextcloud._upload_duplicate(digest, remote_file)
+
+
+class GalleryIndex(object):
+
+    """Lightweight gallery page of the albums, updated after each upload.
+
+    A thumbnail of each picture is generated by the rendering processes
+    and the picture is appended to a manifest (JSON lines with name, size
+    and capture time) split in pages of ``PAGE_SIZE`` entries: only the
+    last page is uploaded again when a picture is added. A static ``index.html`` page, uploaded
+    once per album, loads the manifest pages and displays the thumbnails.
+    """
+
+    DIRNAME = '_gallery'
+    LOCAL_DIRNAME = '.nextcloud_gallery'
+    INDEX_FILENAME = 'index.html'
+    PAGE_SIZE = 100
+    THUMB_SIZE = 320
+    THUMB_QUALITY = 70
+    EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.gif')
+    INDEX_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>{title}</title>
+<style>
+body {{margin: 0; font-family: sans-serif; background: #111; color: #eee}}
+h1 {{font-size: 1.2em; padding: 0 8px}}
+#grid {{display: grid; grid-template-columns: repeat(auto-fill, minmax(150px, 1fr)); gap: 4px; padding: 4px}}
+#grid img {{width: 100%; aspect-ratio: 1; object-fit: cover; display: block}}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+<div id="grid"></div>
+<script>
+async function load() {{
+  var grid = document.getElementById('grid');
+  for (var page = 0; ; page++) {{
+    var response = await fetch('{dirname}/manifest-' + String(page).padStart(4, '0') + '.jsonl', {{cache: 'no-cache'}});
+    if (!response.ok) break;
+    var lines = (await response.text()).split('\n').filter(Boolean);
+    lines.forEach(function (line) {{
+      var entry = JSON.parse(line);
+      var link = document.createElement('a');
+      var img = document.createElement('img');
+      link.href = encodeURIComponent(entry.name);
+      img.src = entry.thumb;
+      img.loading = 'lazy';
+      img.width = entry.width;
+      img.height = entry.height;
+      img.alt = entry.time;
+      img.onerror = function () {{ img.onerror = null; img.src = link.href; }};
+      link.appendChild(img);
+      grid.insertBefore(link, grid.firstChild);
+    }});
+    if (lines.length < {page_size}) break;
+  }}
+}}
+load();
+</script>
+</body>
+</html>
+"""
+
+    def __init__(self, nextcloud):
+        """Initialize the gallery
+        :param nextcloud: instance uploading the pictures
+        :type nextcloud: NextcloudUpload
+        """
+        self.nextcloud = nextcloud
+        self.queue = queue.Queue()
+        self.thread = None
+        self._pages = {}  # album directory: (number of entries, lines of the last page)
+        self._indexed = set()
+
+    def start(self):
+        """Start the thread updating the gallery"""
+        self.thread = threading.Thread(target=self._run, name="NextcloudGallery")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=5):
+        """Ask the thread to terminate and wait for it"""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join(timeout)
+            self.thread = None
+
+    def add(self, local_source_file, remote_file):
+        """Add an uploaded picture to the gallery of its album, never blocks"""
+        remote_dir, filename = os.path.split(remote_file)
+        if os.path.splitext(filename)[1].lower() not in self.EXTENSIONS \
+                or not self.nextcloud.is_album_picture(remote_file):
+            return
+        self.queue.put((local_source_file, remote_dir, filename))
+
+    def _run(self):
+        """Gallery thread main loop"""
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            try:
+                self._append(*job)
+            except Exception as e:
+                LOGGER.warning("Could not update the gallery of %s: %s", job[1], str(e))
+
+    def _local_dir(self, remote_dir):
+        """Return the local directory of the manifest of an album"""
+        key = hashlib.sha1('|'.join((self.nextcloud.nhost, remote_dir)).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.nextcloud.local_rep, self.LOCAL_DIRNAME, key)
+
+    def _load_page(self, remote_dir):
+        """Return the number of entries and the last page of an album"""
+        if remote_dir not in self._pages:
+            local_dir = self._local_dir(remote_dir)
+            os.makedirs(local_dir, exist_ok=True)
+            lines = []
+            try:
+                with open(os.path.join(local_dir, 'manifest.jsonl'), encoding='utf-8') as fp:
+                    lines = fp.read().splitlines()
+            except OSError:
+                pass
+            count = len(lines)
+            self._pages[remote_dir] = (count, lines[count - count % self.PAGE_SIZE:])
+        return self._pages[remote_dir]
+
+    def _upload_index(self, remote_dir):
+        """Create the gallery directories and upload the index page"""
+        nextcloud = self.nextcloud
+        nextcloud._mkcol(remote_dir + '/' + self.DIRNAME)
+        nextcloud._mkcol(remote_dir + '/' + self.DIRNAME + '/thumbs')
+        html = self.INDEX_HTML.format(title=os.path.basename(remote_dir), dirname=self.DIRNAME,
+                                      page_size=self.PAGE_SIZE)
+        self._put_data(remote_dir + '/' + self.INDEX_FILENAME, html.encode('utf-8'), 'text/html; charset=utf-8')
+
+    def _put_data(self, remote_file, data, content_type):
+        """Upload a small file from memory"""
+        response = self.nextcloud.http.request('PUT', self.nextcloud._dav_url(remote_file), data=data,
+                                               headers={'Content-Type': content_type})
+        if response.status_code not in (200, 201, 204):
+            raise owncloud.HTTPResponseError(response)
+
+    def _append(self, local_source_file, remote_dir, filename):
+        """Generate the thumbnail of a picture, append the picture to the
+        manifest and upload them. The index page is uploaded once per run
+        and per album to keep it up to date with the plugin version.
+        """
+        if remote_dir not in self._indexed:
+            self._upload_index(remote_dir)
+            self._indexed.add(remote_dir)
+        count, page = self._load_page(remote_dir)
+
+        thumb_name = os.path.splitext(filename)[0] + '.jpg'
+        thumb_file = os.path.join(self.nextcloud.local_rep, self.LOCAL_DIRNAME, 'thumbs', thumb_name)
+        if not os.path.isfile(thumb_file):
+            os.makedirs(os.path.dirname(thumb_file), exist_ok=True)
+            self.nextcloud.render(make_web_rendition, local_source_file, thumb_file, self.THUMB_SIZE,
+                                  self.THUMB_QUALITY)
+        with Image.open(local_source_file) as image:
+            width, height = image.size
+            taken = image.getexif().get(306)  # DateTime
+        if taken:
+            taken = taken.replace(':', '-', 2).replace(' ', 'T')
+        else:
+            taken = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(os.path.getmtime(local_source_file)))
+        line = json.dumps({'name': filename, 'width': width, 'height': height, 'time': taken,
+                           'thumb': '/'.join((self.DIRNAME, 'thumbs', quote(thumb_name)))}, separators=(',', ':'))
+        with open(os.path.join(self._local_dir(remote_dir), 'manifest.jsonl'), 'a', encoding='utf-8') as fp:
+            fp.write(line + '\n')
+        if count % self.PAGE_SIZE == 0:
+            page = []
+        page.append(line)
+        self._pages[remote_dir] = (count + 1, page)
+
+        # The page displays the picture itself if its thumbnail is missing
+        try:
+            self.nextcloud._put_file('/'.join((remote_dir, self.DIRNAME, 'thumbs', thumb_name)),
+                                     thumb_file, file_checksum(thumb_file))
+        except Exception as e:
+            LOGGER.warning("Could not upload the thumbnail of %s: %s", filename, str(e))
+        page_file = '{}/{}/manifest-{:04d}.jsonl'.format(remote_dir, self.DIRNAME, count // self.PAGE_SIZE)
+        self._put_data(page_file, ('\n'.join(page) + '\n').encode('utf-8'), 'application/x-ndjson')
+
+
+class PhotoShares(object):
+
+    """Public links and QR codes of the uploaded pictures.
+
+    The pictures are grouped in batches once uploaded: the share requests
+    of a batch are sent together over the keep-alive connections of the
+    pool, then the QR codes are rendered and kept as surfaces so that they
+    are displayed without delay.
+    """
+
+    BATCH_SIZE = 8
+    BATCH_DELAY = 0.5
+    MAX_IMAGES = 20
+
+    def __init__(self, nextcloud):
+        """Initialize the shares
+        :param nextcloud: instance uploading the pictures
+        :type nextcloud: NextcloudUpload
+        """
+        self.nextcloud = nextcloud
+        self.queue = queue.Queue()
+        self.thread = None
+        self.executor = None
+        self.images = collections.OrderedDict()  # picture: [link, surface, display surface]
+        self.displayed = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(filename):
+        """Return the key of a picture, the same for the capture and its
+        web rendition
+        """
+        return os.path.splitext(os.path.basename(filename))[0]
+
+    def start(self):
+        """Start the thread creating the shares"""
+        self.executor = concurrent.futures.ThreadPoolExecutor(max(1, self.nextcloud.http.pool_size),
+                                                              thread_name_prefix="NextcloudShare")
+        self.thread = threading.Thread(target=self._run, name="NextcloudPhotoShares")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self, timeout=5):
+        """Ask the thread to terminate and wait for it"""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join(timeout)
+            self.thread = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def add(self, local_source_file, remote_file):
+        """Share an uploaded picture, never blocks"""
+        if not self.nextcloud.is_album_picture(remote_file):
+            return
+        self.queue.put((self._key(local_source_file), remote_file))
+
+    def link(self, picture_file):
+        """Return the share link of a picture or None if not ready"""
+        with self._lock:
+            entry = self.images.get(self._key(picture_file))
+        return entry[0] if entry else None
+
+    def display_qr_image(self, picture_file):
+        """Return the QR code of a picture converted to the display pixel
+        format, only once after it is ready
+        Returns: pygame.Surface - QR code image or None
+        """
+        key = self._key(picture_file)
+        if key == self.displayed:
+            return None
+        with self._lock:
+            entry = self.images.get(key)
+        if entry is None:
+            return None
+        if entry[2] is None:
+            entry[2] = entry[1].convert()
+        self.displayed = key
+        return entry[2]
+
+    def _run(self):
+        """Share thread main loop, the pictures uploaded within
+        ``BATCH_DELAY`` seconds are shared together
+        """
+        running = True
+        while running:
+            job = self.queue.get()
+            if job is None:
+                break
+            batch = [job]
+            deadline = time.time() + self.BATCH_DELAY
+            while len(batch) < self.BATCH_SIZE:
+                try:
+                    job = self.queue.get(timeout=max(0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if job is None:
+                    running = False
+                    break
+                batch.append(job)
+            try:
+                self._share(batch)
+            except Exception:
+                LOGGER.error("Unexpected error while sharing pictures:\n%s", traceback.format_exc())
+
+    def _share(self, batch):
+        """Create the share links and the QR codes of a batch of pictures"""
+        with self.nextcloud.metrics.timer('photo_shares'):
+            links = list(self.executor.map(self._create_link, [remote_file for _, remote_file in batch]))
+        for (key, _), link in zip(batch, links):
+            if not link:
+                continue
+            surface = self.nextcloud.render_qr(link, filename=None, cache=False)
+            with self._lock:
+                self.images[key] = [link, surface, None]
+                while len(self.images) > self.MAX_IMAGES:
+                    self.images.popitem(last=False)
+        LOGGER.info("Shared %d/%d picture(s)", len([link for link in links if link]), len(batch))
+
+    def _create_link(self, remote_file):
+        """Create the public link of a file
+        Returns: str - share link or None if failed
+        """
+        nextcloud = self.nextcloud
+        try:
+            response = nextcloud.http.request('POST', f"{nextcloud.nhost}/ocs/v1.php/apps/files_sharing/api/v1/shares",
+                                              headers={'OCS-APIRequest': 'true'},
+                                              data={'path': remote_file, 'shareType': 3})
+            if response.status_code != 200:
+                raise owncloud.HTTPResponseError(response)
+            return ET.fromstring(response.content).findtext('data/url')
+        except Exception as e:
+            nextcloud.metrics.inc('errors_total', stage='photo_shares', status=str(getattr(e, 'status_code', 'other')))
+            LOGGER.warning("Could not share %s: %s", remote_file, str(e))
+            return None
+
+
+class SpoolManager(object):
+
+    """Pictures kept on the booth until they are uploaded to all targets.
+
+    Each capture is hard linked (copied if on another file system) in the
+    spool directory by a background thread when queued, so that it can
+    still be uploaded if it is removed from the pibooth directory. The
+    files of the spool are indexed
+    in the upload journal: nothing is scanned at start-up. Uploaded files
+    are removed, oldest first, when the spool exceeds ``max_bytes`` or when
+    they are older than ``retention`` seconds.
+    """
+
+    EVICT_INTERVAL = 30
+    EVICT_PAGE = 100
+
+    def __init__(self, nextcloud, directory, max_bytes=0, retention=0, evict_captures=False):
+        """Initialize the spool
+        :param nextcloud: instance owning the upload journal
+        :type nextcloud: NextcloudUpload
+        :param max_bytes: maximum size of the spool (0 for unlimited)
+        :type max_bytes: int
+        :param retention: delay in seconds before removing uploaded files (0 to keep them)
+        :type retention: int
+        :param evict_captures: remove the captures from the pibooth directory too
+        :type evict_captures: bool
+        """
+        self.nextcloud = nextcloud
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.retention = retention
+        self.evict_captures = evict_captures
+        self.size = nextcloud.journal.spool_size()
+        self._last_eviction = 0
+        self._size_lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix="NextcloudSpool")
+        os.makedirs(directory, exist_ok=True)
+        nextcloud.metrics.set('spool_bytes', self.size)
+
+    def stop(self, timeout=5):
+        """Wait for the captures being added to the spool"""
+        self.executor.shutdown(wait=True)
+
+    def add_later(self, filename, callback):
+        """Keep a capture in the spool in background, then call ``callback``
+        with the path of the file to upload
+        """
+        def add():
+            try:
+                callback(self.add(filename))
+            except Exception:
+                LOGGER.error("Unexpected error while spooling %s:\n%s", filename, traceback.format_exc())
+
+        self.executor.submit(add)
+
+    def add(self, filename):
+        """Keep a capture in the spool
+        Returns: str - path of the file to upload (the capture itself if it
+                 could not be kept in the spool)
+        """
+        path = os.path.join(self.directory, os.path.basename(filename))
+        try:
+            if not (os.path.exists(path) and os.path.samefile(path, filename)):
+                if os.path.exists(path):
+                    os.remove(path)
+                try:
+                    os.link(filename, path)
+                except OSError:
+                    shutil.copy2(filename, path)
+            self._record(path, filename)
+            return path
+        except OSError as e:
+            LOGGER.warning("Could not keep %s in the spool: %s", filename, str(e))
+            return filename
+
+    def register(self, filename):
+        """Manage a file generated for the upload (web rendition)"""
+        try:
+            self._record(filename, None)
+        except OSError as e:
+            LOGGER.warning("Could not add %s to the spool: %s", filename, str(e))
+
+    def _record(self, path, source):
+        size = os.path.getsize(path)
+        self.nextcloud.journal.spool_add(path, size, source)
+        with self._size_lock:
+            self.size += size
+        self.nextcloud.metrics.set('spool_bytes', self.size)
+
+    def _uploaded(self, path):
+        """Return True if the file is uploaded to all the targets, a file
+        not yet queued (or a journal not yet open) is never considered as
+        uploaded
+        """
+        for target in [self.nextcloud] + self.nextcloud.targets:
+            if target.journal is None or target.journal.state(path) != UploadJournal.DONE:
+                return False
+        return True
+
+    def evict_later(self):
+        """Remove the uploaded files if needed, at most every
+        ``EVICT_INTERVAL`` seconds
+        """
+        if time.time() - self._last_eviction > self.EVICT_INTERVAL:
+            self.evict()
+
+    def evict(self):
+        """Remove the oldest uploaded files until the spool size and age
+        limits are respected
+        Returns: int - number of files removed
+        """
+        if not self.max_bytes and not self.retention:
+            return 0
+        if self.nextcloud.journal is None:
+            return 0  # Stopped
+        if not self._evict_lock.acquire(blocking=False):
+            return 0  # Eviction already running
+        self._last_eviction = time.time()
+        deadline = time.time() - self.retention if self.retention else 0
+        removed = kept = 0
+        try:
+            done = False
+            while not done:
+                entries = self.nextcloud.journal.spool_entries(self.EVICT_PAGE, kept)
+                done = len(entries) < self.EVICT_PAGE
+                for path, size, source, added in entries:
+                    if not (self.max_bytes and self.size > self.max_bytes) and added >= deadline:
+                        done = True
+                        break
+                    if not self._uploaded(path):
+                        kept += 1  # Waiting for upload, never removed
+                        continue
+                    for filename in (path, source if self.evict_captures else None):
+                        if filename:
+                            try:
+                                os.remove(filename)
+                            except FileNotFoundError:
+                                pass
+                    self.nextcloud.journal.spool_delete(path)
+                    with self._size_lock:
+                        self.size -= size
+                    removed += 1
+        except OSError as e:
+            LOGGER.warning("Could not clean the spool: %s", str(e))
+        finally:
+            self._evict_lock.release()
+        if removed:
+            LOGGER.info("Spool: %d uploaded file(s) removed, %.1f MB used", removed, self.size / 1024 / 1024)
+        if self.max_bytes and self.size > self.max_bytes:
+            LOGGER.warning("Spool full of pictures waiting for upload (%.1f MB)", self.size / 1024 / 1024)
+        self.nextcloud.metrics.set('spool_bytes', self.size)
+        return removed
+
+
+class UploadJournal(object):
+
+    """Durable record of the upload state of each picture.
+
+    Entries are stored in a SQLite database indexed by state, so resuming
+    after a crash only reads the unfinished uploads. Writes are grouped
+    and committed every ``COMMIT_INTERVAL`` seconds or ``COMMIT_BATCH``
+    changes to limit the number of fsync on the SD card.
+    """
+
+    FILENAME = '.nextcloud_journal.db'
+
+    PENDING = 'pending'
+    QUEUED = 'queued'
+    IN_FLIGHT = 'inflight'
+    DONE = 'done'
+
+    COMMIT_INTERVAL = 1.0
+    COMMIT_BATCH = 50
+
+    def __init__(self, path):
+        """Open (or create) the journal
+        :param path: path to the SQLite database file
+        :type path: str
+        """
+        self.path = path
+        self._lock = threading.RLock()
+        self._changes = 0
+        self._timer = None
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS uploads ("
+                         "local TEXT PRIMARY KEY, "
+                         "remote TEXT NOT NULL, "
+                         "state TEXT NOT NULL, "
+                         "attempts INTEGER NOT NULL DEFAULT 0, "
+                         "updated REAL NOT NULL)")
+        if 'priority' not in [row[1] for row in self._db.execute("PRAGMA table_info(uploads)")]:
+            self._db.execute("ALTER TABLE uploads ADD COLUMN priority INTEGER NOT NULL DEFAULT 1")
+        self._db.execute("DROP INDEX IF EXISTS uploads_state")
+        self._db.execute("CREATE INDEX IF NOT EXISTS uploads_pending ON uploads (state, priority, updated)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS transfers ("
+                         "local TEXT PRIMARY KEY, "
+                         "transfer_id TEXT NOT NULL, "
+                         "remote TEXT NOT NULL, "
+                         "size INTEGER NOT NULL, "
+                         "mtime REAL NOT NULL, "
+                         "chunk_size INTEGER NOT NULL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS contents ("
+                         "digest TEXT PRIMARY KEY, "
+                         "remote TEXT NOT NULL, "
+                         "size INTEGER NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS contents_remote ON contents (remote)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS spool ("
+                         "path TEXT PRIMARY KEY, "
+                         "size INTEGER NOT NULL, "
+                         "source TEXT, "
+                         "added REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS spool_added ON spool (added)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS manifest ("
+                         "name TEXT PRIMARY KEY, "
+                         "size INTEGER NOT NULL, "
+                         "mtime REAL NOT NULL, "
+                         "checksum TEXT NOT NULL, "
+                         "etag TEXT)")
+        self._db.commit()
+
+    def _changed(self):
+        """Commit now if the batch is full, else schedule a delayed commit"""
+        self._changes += 1
+        if self._changes >= self.COMMIT_BATCH:
+            self.flush()
+        elif self._timer is None:
+            self._timer = threading.Timer(self.COMMIT_INTERVAL, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """Commit pending changes to disk"""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            if self._changes and self._db is not None:
+                self._db.commit()
+                self._changes = 0
+
+    def add(self, local_source_file, remote_file, state=PENDING, priority=1):
+        """Record a new picture to upload"""
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO uploads (local, remote, state, attempts, updated, priority) "
+                             "VALUES (?, ?, ?, 0, ?, ?)",
+                             (local_source_file, remote_file, state, time.time(), priority))
+            self._changed()
+
+    def set_state(self, local_source_file, state, failed=False):
+        """Update the state of a picture
+        :param failed: increment the number of failed attempts
+        :type failed: bool
+        """
+        with self._lock:
+            self._db.execute("UPDATE uploads SET state = ?, attempts = attempts + ?, updated = ? WHERE local = ?",
+                             (state, 1 if failed else 0, time.time(), local_source_file))
+            self._changed()
+
+    def recover(self):
+        """Mark uploads interrupted by a crash as pending again
+        Returns: int - number of pictures to resume
+        """
+        with self._lock:
+            self._db.execute("UPDATE uploads SET state = ? WHERE state IN (?, ?)",
+                             (self.PENDING, self.QUEUED, self.IN_FLIGHT))
+            self._db.commit()
+            count = self._db.execute("SELECT COUNT(*) FROM uploads WHERE state = ?",
+                                     (self.PENDING,)).fetchone()[0]
+        if count:
+            LOGGER.info("Upload journal: %d picture(s) waiting for upload", count)
+        return count
+
+    def state(self, local_source_file):
+        """Return the upload state of a picture or None if unknown"""
+        with self._lock:
+            row = self._db.execute("SELECT state FROM uploads WHERE local = ?", (local_source_file,)).fetchone()
+        return row[0] if row else None
+
+    def count(self, state):
+        """Return the number of pictures in the given state"""
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM uploads WHERE state = ?", (state,)).fetchone()[0]
+
+    def pending(self, limit=None):
+        """Return the pending uploads by priority and age as a list of
+        (local, remote, priority)
+        """
+        with self._lock:
+            return self._db.execute("SELECT local, remote, priority FROM uploads WHERE state = ? "
+                                    "ORDER BY priority, updated LIMIT ?",
+                                    (self.PENDING, -1 if limit is None else limit)).fetchall()
+
+    def spool_add(self, path, size, source=None):
+        """Record a file kept in the spool
+        :param source: file of the pibooth directory it is linked to
+        :type source: str
+        """
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO spool (path, size, source, added) VALUES (?, ?, ?, ?)",
+                             (path, size, source, time.time()))
+            self._changed()
+
+    def spool_size(self):
+        """Return the total size in bytes of the files of the spool"""
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM spool").fetchone()[0]
+
+    def spool_entries(self, limit=None, offset=0):
+        """Return the files of the spool, oldest first, as a list of
+        (path, size, source, added)
+        """
+        with self._lock:
+            return self._db.execute("SELECT path, size, source, added FROM spool ORDER BY added LIMIT ? OFFSET ?",
+                                    (-1 if limit is None else limit, offset)).fetchall()
+
+    def spool_delete(self, path):
+        """Forget a file removed from the spool"""
+        with self._lock:
+            self._db.execute("DELETE FROM spool WHERE path = ?", (path,))
+            self._db.execute("DELETE FROM uploads WHERE local = ? AND state = ?", (path, self.DONE))
+            self._changed()
+
+    def transfer(self, local_source_file):
+        """Return the chunked transfer in progress for a file as
+        (transfer_id, remote, size, mtime, chunk_size) or None
+        """
+        with self._lock:
+            return self._db.execute("SELECT transfer_id, remote, size, mtime, chunk_size FROM transfers "
+                                    "WHERE local = ?", (local_source_file,)).fetchone()
+
+    def set_transfer(self, local_source_file, transfer_id, remote_file, size, mtime, chunk_size):
+        """Record a chunked transfer in progress"""
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO transfers "
+                             "(local, transfer_id, remote, size, mtime, chunk_size) VALUES (?, ?, ?, ?, ?, ?)",
+                             (local_source_file, transfer_id, remote_file, size, mtime, chunk_size))
+            self._changed()
+
+    def delete_transfer(self, local_source_file):
+        """Forget a finished chunked transfer"""
+        with self._lock:
+            self._db.execute("DELETE FROM transfers WHERE local = ?", (local_source_file,))
+            self._changed()
+
+    def content(self, digest):
+        """Return the remote path of a content already uploaded, or None"""
+        with self._lock:
+            row = self._db.execute("SELECT remote FROM contents WHERE digest = ?", (digest,)).fetchone()
+        return row[0] if row else None
+
+    def set_content(self, digest, remote_file, size):
+        """Record a content confirmed on the server"""
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO contents (digest, remote, size) VALUES (?, ?, ?)",
+                             (digest, remote_file, size))
+            self._changed()
+
+    def delete_content(self, remote_file):
+        """Forget the contents recorded at a path not found on the server"""
+        with self._lock:
+            self._db.execute("DELETE FROM contents WHERE remote = ?", (remote_file,))
+            self._changed()
+
+    def manifest(self):
+        """Return the synchronized files as {name: (size, mtime, checksum, etag)}"""
+        with self._lock:
+            return {row[0]: row[1:] for row in
+                    self._db.execute("SELECT name, size, mtime, checksum, etag FROM manifest")}
+
+    def set_manifest(self, name, size, mtime, checksum, etag):
+        """Record the state of a synchronized file"""
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO manifest (name, size, mtime, checksum, etag) "
+                             "VALUES (?, ?, ?, ?, ?)", (name, size, mtime, checksum, etag))
+            self._changed()
+
+    def close(self):
+        """Commit pending changes and close the database"""
+        with self._lock:
+            self.flush()
+            self._db.close()
+            self._db = None
+
+
+class TokenBucket(object):
+
+    """Upload bandwidth limiter shared by all the upload threads.
+
+    The rate is given in kbit/s and may change with the time of day using
+    profiles like ``08:00-18:00=2000,18:00-02:00=0`` (0 means unlimited).
+    A burst of one second of traffic is allowed.
+    """
+
+    def __init__(self, rate_kbps=0, profiles=''):
+        """Initialize the limiter
+        :param rate_kbps: default rate, 0 for unlimited
+        :type rate_kbps: int
+        :param profiles: rates by time of day
+        :type profiles: str
+        """
+        self.rate_kbps = max(0, rate_kbps)
+        self.profiles = []
+        self.tokens = 0.
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+        for profile in profiles.replace(';', ',').split(','):
+            if not profile.strip():
+                continue
+            try:
+                period, rate = profile.split('=')
+                begin, end = (self._minutes(value) for value in period.split('-'))
+                self.profiles.append((begin, end, max(0, int(rate))))
+            except ValueError:
+                LOGGER.warning("Invalid upload rate profile ignored: '%s'", profile.strip())
+
+    @staticmethod
+    def _minutes(value):
+        hours, minutes = value.strip().split(':')
+        return int(hours) * 60 + int(minutes)
+
+    def rate(self, now=None):
+        """Return the allowed rate in bytes per second at the given time
+        Returns: float - 0 if unlimited
+        """
+        now = time.localtime(now)
+        minutes = now.tm_hour * 60 + now.tm_min
+        rate_kbps = self.rate_kbps
+        for begin, end, profile_rate in self.profiles:
+            if begin <= minutes < end or (end < begin and (minutes >= begin or minutes < end)):
+                rate_kbps = profile_rate
+                break
+        return rate_kbps * 1000 / 8.
+
+    def reserve(self, nbytes):
+        """Reserve the given number of bytes
+        :param nbytes: number of bytes about to be sent
+        :type nbytes: int
+        Returns: float - delay in seconds to wait before sending them
+        """
+        rate = self.rate()
+        if not rate:
+            return 0
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(rate, self.tokens + (now - self.last) * rate) - nbytes
+            self.last = now
+            return max(0, -self.tokens / rate)
+
+    def consume(self, nbytes):
+        """Wait until the given number of bytes can be sent
+        :param nbytes: number of bytes about to be sent
+        :type nbytes: int
+        """
+        delay = self.reserve(nbytes)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class FileSlice(object):
+
+    """Read-only file-like view on a part of an opened file.
+
+    It is given as request body to stream a chunk from disk without
+    loading it in memory, at the pace allowed by the optional throttle.
+    The blocks read are given to the optional :class:`StreamDigests`.
+    """
+
+    BLOCK_SIZE = 64 * 1024
+
+    def __init__(self, fp, offset, length, throttle=None, digests=None):
+        self.fp = fp
+        self.offset = offset
+        self.length = length
+        self.position = 0
+        self.throttle = throttle
+        self.digests = digests
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        block = self.read(self.BLOCK_SIZE)
+        while block:
+            yield block
+            block = self.read(self.BLOCK_SIZE)
+
+    def seek(self, position):
+        self.position = position
+
+    def read(self, size=-1):
+        remaining = self.length - self.position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return b''
+        if self.throttle is not None:
+            self.throttle.consume(size)
+        self.fp.seek(self.offset + self.position)
+        data = self.fp.read(size)
+        if self.digests is not None:
+            self.digests.update(self.offset + self.position, data)
+        self.position += len(data)
+        return data
+
+
+class StreamDigests(object):
+
+    """BLAKE2b and SHA1 digests of a file computed from the blocks read to
+    upload it, so that the file is read only once.
+
+    Blocks may be read again (retries) or skipped: only the data following
+    the part already hashed is taken into account.
+    """
+
+    def __init__(self):
+        self.blake2 = hashlib.blake2b(digest_size=20)
+        self.sha1 = hashlib.sha1()
+        self.position = 0
+
+    def update(self, offset, data):
+        """Hash a block read at the given offset of the file"""
+        end = offset + len(data)
+        if offset <= self.position < end:
+            view = memoryview(data)[self.position - offset:]
+            self.blake2.update(view)
+            self.sha1.update(view)
+            self.position = end
+
+    def feed(self, data):
+        """Read a file slice until its end only to hash it, nothing is read
+        if it is already hashed
+        :param data: file slice created with this instance
+        :type data: FileSlice
+        """
+        if self.position >= data.offset + data.length:
+            return
+        data.seek(max(0, self.position - data.offset))
+        while data.read(FileSlice.BLOCK_SIZE):
+            pass
+
+    def hexdigests(self):
+        """Return the digests of the data hashed so far
+        Returns: (str, str) - (blake2b, sha1)
+        """
+        return self.blake2.hexdigest(), self.sha1.hexdigest()